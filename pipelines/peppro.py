@@ -11,20 +11,33 @@ from argparse import ArgumentParser
 import os
 import sys
 import re
+import stat
+import gzip
+import json
+import shutil
+import subprocess
 import tempfile
+import atexit
 import tarfile
+import zlib
 import pypiper
 import errno
+import functools
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pypiper import build_command
-from refgenconf import RefGenConf as RGC, select_genome_config
 
 TOOLS_FOLDER = "tools"
+TOOLS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), TOOLS_FOLDER)
 RUNON_SOURCE_PRO = ["PRO", "pro", "PRO-SEQ", "PRO-seq", "proseq", "PROSEQ"]
 RUNON_SOURCE_GRO = ["GRO", "gro", "groseq", "GROSEQ", "GRO-SEQ", "GRO-seq"]
 RUNON_SOURCE = RUNON_SOURCE_PRO + RUNON_SOURCE_GRO
 
 ADAPTER_REMOVERS = ["cutadapt", "fastp"]
-DEDUPLICATORS = ["seqkit", "fqdedup"]
+DEDUPLICATORS = ["seqkit", "fqdedup", "fastp", "dedup_fastq"]
 TRIMMERS = ["seqtk", "fastx"]
 
 DEFAULT_REMOVER = "cutadapt"
@@ -32,9 +45,19 @@ DEFAULT_DEDUPLICATOR = "seqkit"
 DEFAULT_TRIMMER = "seqtk"
 
 BT2_IDX_KEY = "bowtie2_index"
+BT2_IDX_SUFFIXES = [".1.bt2", ".2.bt2", ".3.bt2", ".4.bt2",
+                    ".rev.1.bt2", ".rev.2.bt2"]
 DEFAULT_UMI_LEN = 0
 DEFAULT_MAX_LEN = -1
 
+# FASTQ quality encodings and their ASCII (min, max) ranges
+QUAL_ENCODINGS = np.array(["Sanger", "Illumina-1.8", "Solexa",
+                           "Illumina-1.3", "Illumina-1.5"])
+QUAL_ENC_MINS = np.array([33, 33, 59, 64, 67])
+QUAL_ENC_MAXS = np.array([73, 74, 104, 104, 105])
+# Number of quality lines reduced together when guessing the encoding
+QUAL_SCAN_BATCH = 1000
+
 def parse_arguments():
     """
     Parse command-line arguments passed to the pipeline.
@@ -74,7 +97,7 @@ def parse_arguments():
                              "Default: {}".format(DEFAULT_UMI_LEN))
 
     parser.add_argument("--max-len",
-                        default=DEFAULT_MAX_LEN,
+                        default=DEFAULT_MAX_LEN, type=int,
                         help="Trim reads to maximum length. "
                              "Set to -1 to disable length trimming. "
                              "Default: {}".format(DEFAULT_MAX_LEN))
@@ -161,6 +184,11 @@ def parse_arguments():
                         dest="keep",
                         help="Keep prealignment BAM files.")
 
+    parser.add_argument("--cram", action='store_true', default=False,
+                        dest="cram",
+                        help="Write kept prealignment alignments (--keep) as "
+                             "reference-free CRAM instead of BAM.")
+
     parser.add_argument("--keep-mito", action='store_true', default=False,
                         dest="keep_mito",
                         help="Keep mitochondrial aligning reads.")
@@ -169,9 +197,17 @@ def parse_arguments():
                         dest="no_fifo",
                         help="Do NOT use named pipes during prealignments.")
 
+    parser.add_argument("--fastq-tmp", default=None, dest="fastq_tmp",
+                        help="Directory for intermediate adapter trimmed and "
+                             "deduplicated FASTQ files, e.g. a tmpfs such as "
+                             "/dev/shm. Default: the sample fastq folder.")
+
     parser.add_argument("--no-complexity", action='store_true', default=False,
                         dest="complexity",
-                        help="Disable library complexity calculation (faster).")
+                        help="Disable library complexity calculation (faster). "
+                             "This also skips UMI deduplication and the "
+                             "duplicate-retaining alignment; recommended for "
+                             "small test runs.")
 
     parser.add_argument("--prioritize", action='store_true', default=False,
                         dest="prioritize",
@@ -191,7 +227,35 @@ def parse_arguments():
     return args
 
 
-def _remove_adapters(args, res, tools, read2, fq_file, outfolder):
+def _fastq_path(folder, sample_name, read, suffix):
+    """
+    Build the path to an intermediate FASTQ file for one read of a sample,
+    e.g. <sample_name>_R1_noadap.fastq.
+
+    :param str folder: directory holding the file
+    :param str sample_name: name of the sample
+    :param int read: read number, 1 or 2
+    :param str suffix: processing step the file holds, e.g. "noadap"
+    :return str: path to the FASTQ file
+    """
+    return os.path.join(folder,
+                        "{}_R{}_{}.fastq".format(sample_name, read, suffix))
+
+
+def _scratch_folder(args, outfolder):
+    """
+    Get the folder for intermediate adapter trimmed and deduplicated reads.
+
+    :param argparse.Namespace args: binding between option name and argument,
+        e.g. from parsing command-line options
+    :param str outfolder: path to output directory for the pipeline
+    :return str: path to the folder for intermediate FASTQ files
+    """
+    return args.fastq_tmp or os.path.join(outfolder, "fastq")
+
+
+def _remove_adapters(args, res, tools, read2, fq_file, outfolder,
+                     trim=False):
     """
     A helper function to build a command for adapter removal.
 
@@ -205,6 +269,8 @@ def _remove_adapters(args, res, tools, read2, fq_file, outfolder):
         intermediate files
     :param str fq_file: path to FASTQ file
     :param str outfolder: path to output directory for the pipeline
+    :param bool trim: if True, also remove UMIs, trim and orient the reads
+        with fastp in the same pass (fastp only)
     :return str: command to remove adapters
     """
 
@@ -213,18 +279,19 @@ def _remove_adapters(args, res, tools, read2, fq_file, outfolder):
     cutadapt_folder = os.path.join(outfolder, "cutadapt")
     fastp_folder = os.path.join(outfolder, "fastp")
     fastq_folder = os.path.join(outfolder, "fastq")
+    scratch_folder = _scratch_folder(args, outfolder)
 
     if read2:
         cutadapt_report = os.path.join(cutadapt_folder,
             sname + "_R2_cutadapt.txt")
-        noadap_fastq = os.path.join(fastq_folder, sname + "_R2_noadap.fastq")
-        short_fastq = os.path.join(fastq_folder, sname + "_R2_short.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 2, "noadap")
+        short_fastq = _fastq_path(fastq_folder, sname, 2, "short")
         fastp_pfx = os.path.join(fastp_folder, sname + "_R2_fastp_adapter")
     else:
         cutadapt_report = os.path.join(cutadapt_folder,
             sname + "_R1_cutadapt.txt")
-        noadap_fastq = os.path.join(fastq_folder, sname + "_R1_noadap.fastq")
-        short_fastq = os.path.join(fastq_folder, sname + "_R1_short.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 1, "noadap")
+        short_fastq = _fastq_path(fastq_folder, sname, 1, "short")
         fastp_pfx = os.path.join(fastp_folder, sname + "_R1_fastp_adapter")
 
     fastp_report_txt = fastp_pfx + ".txt"
@@ -233,120 +300,81 @@ def _remove_adapters(args, res, tools, read2, fq_file, outfolder):
 
     if _itsa_file(res.adapters):
         pm.info("Using custom adapter file: {}".format(res.adapters))
-        five_prime = pm.checkprint("awk '/5prime/{getline; print}' " +
-            res.adapters) or "TGGAATTCTCGGGTGCCAAGG"
-        three_prime = pm.checkprint("awk '/3prime/{getline; print}' " +
-            res.adapters) or "GATCGTCGGACTGTAGAACTCTGAAC"
+        five_prime, three_prime = _read_adapters(res.adapters)
+        five_prime = five_prime or "TGGAATTCTCGGGTGCCAAGG"
+        three_prime = three_prime or "GATCGTCGGACTGTAGAACTCTGAAC"
     else:
         # Default to the hardcoded values as a fallback
         five_prime = "TGGAATTCTCGGGTGCCAAGG"
         three_prime = "GATCGTCGGACTGTAGAACTCTGAAC"
 
-    # Setup report output folders
-    if args.adapter == "cutadapt":
-        ngstk.make_dir(cutadapt_folder)
-        adapter_report = cutadapt_report
-    elif args.adapter == "fastp":
-        ngstk.make_dir(fastp_folder)
-        adapter_report = fastp_report_txt
+    adapter_seq = three_prime if read2 else five_prime
 
     # Create adapter trimming command(s).
-    if args.adapter == "fastp":
-        adapter_cmd_chunks = [
-            ("(" + tools.fastp),
-            ("--overrepresentation_analysis"),
-            ("--thread", str(pm.cores)),
-            ("--in1", fq_file)
-        ]
-        if read2:
-            adapter_cmd_chunks.extend([
-                ("--adapter_sequence", three_prime)
-            ])
-        else:
-            adapter_cmd_chunks.extend([
-                ("--adapter_sequence", five_prime)
-            ])
-
-        adapter_cmd_chunks.extend([
-            ("--length_required", (2 + int(float(args.umi_len)))),
-            ("--html", fastp_report_html),
-            ("--json", fastp_report_json),
-            ("--report_title", ("'" + sname + "'"))
-        ])
-        # If calculating library complexity and this is read 1 or single-end,
-        # must produce an intermediate file.
-        adapter_cmd_chunks.extend([("-o", noadap_fastq)])
-        # Must keep intermediates always now
-
-        adapter_cmd_chunks.extend([
-            (") 2>", fastp_report_txt)
-        ])
-
-        adapter_cmd = build_command(adapter_cmd_chunks)
-
-    elif args.adapter == "cutadapt":
-        # Must keep intermediates always now
-        cut_version = float(pm.checkprint("cutadapt --version"))
+    # Must keep intermediates always now
+    if args.adapter == "cutadapt":
+        ngstk.make_dir(cutadapt_folder)
+        cut_version = _tool_version(tools.cutadapt, "CUTADAPT_VERSION")
         adapter_cmd_chunks = ["(" + tools.cutadapt]
         # old versions of cutadapt can not use multiple cores
-        if cut_version >= 1.15:
+        if cut_version >= (1, 15):
             adapter_cmd_chunks.extend([("-j", str(pm.cores))])
         adapter_cmd_chunks.extend([
-            ("-m", (2 + int(float(args.umi_len)))),
-            ("-O", 1)
-        ])
-        if read2:
-            adapter_cmd_chunks.extend([("-a", three_prime)])
-        else:
-            adapter_cmd_chunks.extend([("-a", five_prime)])
-        adapter_cmd_chunks.extend([
+            ("-m", (2 + args.umi_len)),
+            ("-O", 1),
+            ("-a", adapter_seq),
             fq_file,
             ("-o", noadap_fastq),
             ("--too-short-output", short_fastq),
             ")",
             (">", cutadapt_report)
         ])
-
-        adapter_cmd = build_command(adapter_cmd_chunks)
-
     else:
         # Default to fastp
+        ngstk.make_dir(fastp_folder)
         adapter_cmd_chunks = [
             ("(" + tools.fastp),
             ("--overrepresentation_analysis"),
             ("--thread", str(pm.cores)),
-            ("--in1", fq_file)
+            ("--in1", fq_file),
+            ("--adapter_sequence", adapter_seq),
+            ("--length_required", (2 + args.umi_len)),
+            ("--html", fastp_report_html),
+            ("--json", fastp_report_json),
+            ("--report_title", ("'" + sname + "'"))
         ]
-        if read2:
+        if trim:
+            # Remove the UMI and trim to max length in the same pass, then
+            # size select and orient the reads
+            processed_fastq = _fastq_path(fastq_folder, sname, 1, "processed")
+            if args.umi_len > 0:
+                adapter_cmd_chunks.extend([
+                    "--umi",
+                    ("--umi_loc", "read1"),
+                    ("--umi_len", args.umi_len)
+                ])
+            if args.max_len > 0:
+                adapter_cmd_chunks.append(("--max_len1", args.max_len))
             adapter_cmd_chunks.extend([
-                ("--adapter_sequence", three_prime)
+                "--stdout",
+                (") 2>", fastp_report_txt),
+                "|"
             ])
+            adapter_cmd_chunks.extend(
+                _size_and_orient(args, tools, "-", processed_fastq))
         else:
             adapter_cmd_chunks.extend([
-                ("--adapter_sequence", five_prime)
+                ("-o", noadap_fastq),
+                (") 2>", fastp_report_txt)
             ])
 
-        adapter_cmd_chunks.extend([
-            ("--length_required", (2 + int(float(args.umi_len)))),
-            ("--html", fastp_report_html),
-            ("--json", fastp_report_json),
-            ("--report_title", ("'" + sname + "'"))
-        ])
-        # If calculating library complexity and this is read 1 or single-end,
-        # must produce an intermediate file.
-        adapter_cmd_chunks.extend([("-o", noadap_fastq)])
-        # Must keep intermediates always now
-
-        adapter_cmd_chunks.extend([
-            (") 2>", fastp_report_txt)
-        ])
-
-        adapter_cmd = build_command(adapter_cmd_chunks)
+    adapter_cmd = build_command(adapter_cmd_chunks)
 
     return adapter_cmd
 
 
-def _deduplicate(args, tools, fq_file, outfolder):
+def _deduplicate(args, tools, fq_file, outfolder, stream=False,
+                 input_fastq=None):
     """
     A helper function to build a command for deduplication.
 
@@ -356,57 +384,241 @@ def _deduplicate(args, tools, fq_file, outfolder):
         value, e.g. for tools/resources used by the pipeline
     :param str fq_file: path to FASTQ file
     :param str outfolder: path to output directory for the pipeline
+    :param bool stream: if True, write deduplicated reads to stdout and log
+        the number of duplicates removed (seqkit and dedup_fastq only)
+    :param str input_fastq: path to read adapter trimmed reads from, or "-"
+        for stdin; defaults to the adapter trimmed FASTQ file
     :return str: command to remove adapters
     """
     sname = args.sample_name  # for concise code
 
     fastq_folder = os.path.join(outfolder, "fastq")
-    noadap_fastq = os.path.join(fastq_folder, sname + "_R1_noadap.fastq")
-    dedup_fastq = os.path.join(fastq_folder, sname + "_R1_dedup.fastq")
+    scratch_folder = _scratch_folder(args, outfolder)
+    noadap_fastq = (input_fastq or
+                    _fastq_path(scratch_folder, sname, 1, "noadap"))
+    dedup_fastq = _fastq_path(scratch_folder, sname, 1, "dedup")
+    dedup_log = os.path.join(fastq_folder, sname + "_R1_dedup.log")
+
+    fastp_folder = os.path.join(outfolder, "fastp")
+    dedup_html = os.path.join(fastp_folder, sname + "_R1_dedup.html")
+    dedup_json = os.path.join(fastp_folder, sname + "_R1_dedup.json")
+
+    # Don't deduplicate a read2 file nor deduplicate if there are no UMI's
+    if args.complexity or args.umi_len <= 0:
+        return ""
+
+    dedup = args.dedup
+    dedup_tool = tool_path("dedup_fastq")
+    if dedup == "dedup_fastq" and not os.access(dedup_tool, os.X_OK):
+        pm.warning("Could not find {}; build it with `make dedup_fastq`. "
+                   "Using seqkit instead.".format(dedup_tool))
+        dedup = "seqkit"
 
     # Create deduplication command(s).
-    if not args.complexity and int(args.umi_len) > 0:
-        if args.dedup == "seqkit":
-            dedup_cmd_chunks = [
-                (tools.seqkit, "rmdup"),
-                ("--threads", str(pm.cores)),
-                "--by-seq",
-                "--ignore-case",
-                "-o"           
+    if dedup == "dedup_fastq":
+        # Single pass over the reads with an in-memory set of sequence hashes,
+        # sized up front from the read count when it is known
+        dedup_cmd_chunks = [dedup_tool]
+        fastq_reads = pm.get_stat("Fastq_reads")
+        if fastq_reads:
+            # Fastq_reads counts both mates of paired-end data
+            expected = int(float(fastq_reads))
+            if args.paired_end:
+                expected = expected // 2
+            dedup_cmd_chunks.append(("-n", expected))
+        dedup_cmd_chunks.extend([noadap_fastq,
+                                 "-" if stream else dedup_fastq])
+    elif dedup == "fqdedup":
+        dedup_cmd_chunks = [
+            tools.fqdedup,
+            ("-i", noadap_fastq),
+            ("-o", dedup_fastq)
+        ]
+    elif dedup == "fastp":
+        # fastp's dedup hash table has a fixed size set by the accuracy
+        # level: about 1, 2, 4, 8, 16 or 24 GB for levels 1 to 6. Level 3,
+        # fastp's default with --dedup, needs about 4 GB. Only deduplicate
+        # in this pass
+        ngstk.make_dir(fastp_folder)
+        dedup_cmd_chunks = [
+            tools.fastp,
+            ("--thread", str(pm.cores)),
+            ("-i", noadap_fastq),
+            ("-o", dedup_fastq),
+            "--dedup",
+            ("--dup_calc_accuracy", 3),
+            "--disable_adapter_trimming",
+            "--disable_quality_filtering",
+            "--disable_length_filtering",
+            "--disable_trim_poly_g",
+            ("--html", dedup_html),
+            ("--json", dedup_json)
+        ]
+    else:
+        # Default to seqkit
+        dedup_cmd_chunks = [
+            (tools.seqkit, "rmdup"),
+            ("--threads", str(pm.cores)),
+            "--by-seq",
+            "--ignore-case",
+            ("-o", "-" if stream else dedup_fastq),
+            noadap_fastq
+        ]
+
+    if stream:
+        # Both tools report "<n> duplicated records removed" on stderr
+        dedup_cmd_chunks.extend([("2>", dedup_log)])
+
+    return build_command(dedup_cmd_chunks)
+
+
+def _size_and_orient(args, tools, fq_in, fq_out):
+    """
+    A helper function to build the final step of read trimming, which
+    removes too short reads and reverse complements PRO-seq reads.
+
+    :param argparse.Namespace args: binding between option name and argument,
+        e.g. from parsing command-line options
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str fq_in: path to input FASTQ file, or "-" to read from a pipe
+    :param str fq_out: path to output FASTQ file
+    :return list: command chunks for the final trimming step
+    """
+    # Do not reverse complement for GRO-seq
+    if args.protocol.lower() in RUNON_SOURCE_GRO:
+        cmd_chunks = [
+            (tools.seqtk, "seq"),
+            ("-L", (2 + args.umi_len)),
+            fq_in
+        ]
+    else:
+        # Prefer the compiled reverse complement helper (`make fastq_revcomp`)
+        revcomp_tool = tool_path("fastq_revcomp")
+        if os.access(revcomp_tool, os.X_OK):
+            cmd_chunks = [
+                revcomp_tool,
+                ("-L", (2 + args.umi_len)),
+                fq_in
             ]
-            if not args.complexity:
-                dedup_cmd_chunks.extend([
-                    (dedup_fastq, noadap_fastq)
-                ])
-            else:
-                dedup_cmd_chunks.extend(["-"])
-            dedup_cmd = build_command(dedup_cmd_chunks)
-        elif args.dedup == "fqdedup":
-            dedup_cmd_chunks = [tools.fqdedup]
-            dedup_cmd_chunks.extend([("-i", noadap_fastq)])
-            dedup_cmd_chunks.extend([("-o", dedup_fastq)])
-            dedup_cmd = build_command(dedup_cmd_chunks)
         else:
-            # Default to seqkit
-            dedup_cmd_chunks = [
-                (tools.seqkit, "rmdup"),
-                ("--threads", str(pm.cores)),
-                "--by-seq",
-                "--ignore-case",
-                "-o"           
+            cmd_chunks = [
+                (tools.seqtk, "seq"),
+                ("-L", (2 + args.umi_len)),
+                ("-r", fq_in)
             ]
-            dedup_cmd_chunks.extend([
-                (dedup_fastq, noadap_fastq)
+    cmd_chunks.append((">", fq_out))
+
+    return cmd_chunks
+
+
+def _fastx_trim(args, tools, encoding, fq_in, fq_out, read2=False):
+    """
+    A helper function to build a FASTX-Toolkit read trimming command, which
+    removes UMIs, trims to max length, removes too short reads and reverse
+    complements PRO-seq reads.
+
+    :param argparse.Namespace args: binding between option name and argument,
+        e.g. from parsing command-line options
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str encoding: quality encoding of the input reads
+    :param str fq_in: path to input FASTQ file, or None to read from a pipe
+    :param str fq_out: path to output FASTQ file
+    :param bool read2: if True, trim the UMI from the 3' end instead
+    :return list: command chunks for the fastx step(s)
+    """
+    trim_tool = tools.fastx + "_trimmer"
+    rc_tool = tools.fastx + "_reverse_complement"
+    cmd_chunks = [trim_tool]
+
+    if encoding == "Illumina-1.8":
+        cmd_chunks.extend([("-Q", str(33))])
+
+    # Remove UMI blindly by position only
+    if read2:
+        cmd_chunks.extend([("-t", str(args.umi_len))])
+    else:
+        cmd_chunks.extend([("-f", str(args.umi_len + 1))])
+        # Trim to max length if specified
+        if args.max_len > 0:
+            cmd_chunks.extend([
+                ("-l", str(args.max_len + args.umi_len))
             ])
-            dedup_cmd = build_command(dedup_cmd_chunks)
+
+    # Remove too short reads
+    cmd_chunks.extend([("-m", (2 + args.umi_len))])
+
+    if fq_in:
+        cmd_chunks.extend([("-i", fq_in)])
+
+    # Do not reverse complement for GRO-seq
+    if args.protocol.lower() in RUNON_SOURCE_GRO:
+        cmd_chunks.extend([("-o", fq_out)])
     else:
-        # Don't deduplicate a read2 file nor deduplicate if there are no UMI's
-        dedup_cmd = ""
+        cmd_chunks.extend([("|", rc_tool)])
+        if encoding == "Illumina-1.8":
+            cmd_chunks.extend([("-Q", str(33))])
+        cmd_chunks.extend([("-o", fq_out)])
+
+    return cmd_chunks
 
-    return dedup_cmd
 
+def _fastp_umi_chunks(args, tools, fq_input, umi_report, umi_json):
+    """
+    Build the command chunks that remove the UMI from read1 using fastp.
 
-def _trim_deduplicated_files(args, tools, fq_file, outfolder):
+    :param argparse.Namespace args: binding between option name and argument,
+        e.g. from parsing command-line options
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str fq_input: path to FASTQ file, or "-" to read from stdin
+    :param str umi_report: path to fastp HTML report
+    :param str umi_json: path to fastp JSON report
+    :return list: command chunks writing UMI trimmed reads to stdout
+    """
+    return [
+        tools.fastp,
+        ("--thread", str(pm.cores)),
+        "--stdin" if fq_input == "-" else ("-i", fq_input),
+        "--stdout",
+        "--umi",
+        ("--umi_loc", "read1"),
+        ("--umi_len", args.umi_len),
+        ("--html", umi_report),
+        ("--json", umi_json)
+    ]
+
+
+def _seqtk_trim_chunks(args, tools, fq_input, read2=False):
+    """
+    Build the command chunks that blindly trim the UMI, and optionally the
+    maximum read length, using seqtk.
+
+    :param argparse.Namespace args: binding between option name and argument,
+        e.g. from parsing command-line options
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str fq_input: path to FASTQ file, or "-" to read from stdin
+    :param bool read2: if True, trim the UMI from the end of the read and
+        leave the read length alone
+    :return list: command chunks piping trimmed reads onward
+    """
+    trim_cmd_chunks = [tools.seqtk, "trimfq"]
+
+    if read2:
+        trim_cmd_chunks.append(("-e", str(args.umi_len)))
+    else:
+        trim_cmd_chunks.append(("-b", str(args.umi_len)))
+        # Trim to max length if specified
+        if args.max_len > 0:
+            trim_cmd_chunks.append(("-L", str(args.max_len)))
+
+    trim_cmd_chunks.extend([fq_input, "|"])
+    return trim_cmd_chunks
+
+
+def _trim_deduplicated_files(args, tools, fq_file, outfolder, stream=False):
     """
     A helper function to build a command for read trimming using fastq files
     that have been deduplicated.
@@ -417,41 +629,32 @@ def _trim_deduplicated_files(args, tools, fq_file, outfolder):
         value, e.g. for tools/resources used by the pipeline
     :param str fq_file: path to FASTQ file
     :param str outfolder: path to output directory for the pipeline
+    :param bool stream: if True, read deduplicated reads from stdin
     :return str: command to trim adapter trimmed and deduplicated reads
     """
 
-    # Only call this when args.complexity32 and int(args.umi_len) > 0
+    # Only call this when args.complexity32 and args.umi_len > 0
     sname = args.sample_name  # for concise code
 
     fastq_folder = os.path.join(outfolder, "fastq")
-    dedup_fastq = os.path.join(fastq_folder, sname + "_R1_dedup.fastq")
-    processed_fastq = os.path.join(fastq_folder, sname + "_R1_trimmed.fastq")
-
-    fastp_folder = os.path.join(outfolder, "fastp")    
-    umi_report = os.path.join(fastp_folder, sname + "_R1_rmUmi.html")
-    umi_json = os.path.join(fastp_folder, sname + "_R1_rmUmi.json")
+    dedup_fastq = _fastq_path(_scratch_folder(args, outfolder), sname, 1,
+                              "dedup")
+    processed_fastq = _fastq_path(fastq_folder, sname, 1, "trimmed")
 
-    # Check quality encoding for use with FastX_Tools
-    if args.trimmer == "fastx":
-        encoding = _guess_encoding(fq_file)
+    # Named apart from the undeduplicated trimming reports, which may be
+    # written at the same time
+    fastp_folder = os.path.join(outfolder, "fastp")
+    umi_report = os.path.join(fastp_folder, sname + "_R1_dedup_rmUmi.html")
+    umi_json = os.path.join(fastp_folder, sname + "_R1_dedup_rmUmi.json")
 
     if args.adapter == "fastp":
         # Remove UMI by specifying location of UMI
         # Location is still read1 because it's being treated as SE data
-        trim_cmd_chunks = [
-            tools.fastp,
-            ("--thread", str(pm.cores)),
-            ("-i", dedup_fastq),
-            "--stdout",
-            "--umi",
-            ("--umi_loc", "read1"),
-            ("--umi_len", args.umi_len),
-            ("--html", umi_report),
-            ("--json", umi_json)
-        ]
+        trim_cmd_chunks = _fastp_umi_chunks(
+            args, tools, "-" if stream else dedup_fastq, umi_report, umi_json)
 
         # Trim to max length if specified
-        if int(args.max_len) > 0:
+        if args.max_len > 0:
             trim_cmd_chunks.extend([
                 "|",
                 (tools.seqtk, "trimfq"),
@@ -459,131 +662,32 @@ def _trim_deduplicated_files(args, tools, fq_file, outfolder):
                 "-"
             ])
 
-        # Remove too short reads
-        trim_cmd_chunks.extend([
-            "|",
-            (tools.seqtk, "seq"),
-            #("-L", 5)
-            ("-L",(2 + int(float(args.umi_len))))
-        ])
+        trim_cmd_chunks.append("|")
+        trim_cmd_chunks.extend(
+            _size_and_orient(args, tools, "-", processed_fastq))
 
-        # Reverse complement for PRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_PRO:
-            trim_cmd_chunks.extend([("-r", "-")])
-        else:
-            trim_cmd_chunks.extend(["-"])
-
-        trim_cmd_chunks.extend([(">", processed_fastq)])
-
-    elif args.trimmer == "seqtk":
-        # Remove UMI by blind trimming
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq",
-            ("-b", str(args.umi_len))
-        ]
-
-        # Trim to max length if specified
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([("-L", str(args.max_len))])
-
-        trim_cmd_chunks.extend([dedup_fastq])
-
-        # Do not reverse complement for GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                "-",
-                (">", processed_fastq)
-            ])                           
-        else:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-r", "-"),
-                (">", processed_fastq)
-            ])
     elif args.trimmer == "fastx":
-        trim_tool = tools.fastx + "_trimmer"
-        rc_tool = tools.fastx + "_reverse_complement"
-        trim_cmd_chunks = [trim_tool]
-
-        if encoding == "Illumina-1.8":
-            trim_cmd_chunks.extend([
-                ("-Q", str(33))
-            ])
-
-        # Remove UMI blindly
-        trim_cmd_chunks.extend([("-f", str(int(float(args.umi_len)) + 1))])
-
-        # Trim to max length if specified
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([
-                ("-l", (str(int(float(args.max_len)) +
-                 int(float(args.umi_len)))))
-            ])
-
-        # Remove too short reads
-        trim_cmd_chunks.extend([("-m", (2 + int(float(args.umi_len))))])
-
-        # Add input file
-        trim_cmd_chunks.extend([("-i", dedup_fastq)])
-
-        # Do not reverse complement if GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([("-o", processed_fastq)])                        
-        else:
-            trim_cmd_chunks.extend([("|", rc_tool)])
-            if encoding == "Illumina-1.8":
-                trim_cmd_chunks.extend([
-                    ("-Q", str(33))
-                ])
-            trim_cmd_chunks.extend([("-o", processed_fastq)])
+        # Check quality encoding for use with FastX_Tools
+        encoding = _guess_encoding(fq_file)
+        trim_cmd_chunks = _fastx_trim(args, tools, encoding,
+                                      None if stream else dedup_fastq,
+                                      processed_fastq)
     else:
         # Default to seqtk
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq",
-            ("-b", str(args.umi_len))
-        ]
-
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([("-L", str(args.max_len))])
-
-        trim_cmd_chunks.extend([dedup_fastq])
-
-        # Do not reverse complement for GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                "-",
-                (">", processed_fastq)
-            ])                           
-        else:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-r", "-"),
-                (">", processed_fastq)
-            ])
+        # Remove UMI by blind trimming
+        trim_cmd_chunks = _seqtk_trim_chunks(
+            args, tools, "-" if stream else dedup_fastq)
+        trim_cmd_chunks.extend(
+            _size_and_orient(args, tools, "-", processed_fastq))
 
     trim_cmd = build_command(trim_cmd_chunks)
-    pm.debug("trim_deduplicated_cmd: {}".format(build_command(trim_cmd_chunks)))
+    pm.debug("trim_deduplicated_cmd: {}".format(trim_cmd))
 
     return trim_cmd
 
 
-def _trim_adapter_files(args, tools, read2, fq_file, outfolder):
+def _trim_adapter_files(args, tools, read2, fq_file, outfolder,
+                        stream=False):
     """
     A helper function to build a command for read trimming using fastq files
     without deduplication.
@@ -596,20 +700,20 @@ def _trim_adapter_files(args, tools, read2, fq_file, outfolder):
         intermediate files
     :param str fq_file: path to FASTQ file
     :param str outfolder: path to output directory for the pipeline
+    :param bool stream: if True, read adapter trimmed reads from stdin
     :return str: command to trim adapter trimmed files
     """
     # Need undeduplicated results for complexity calculation
     sname = args.sample_name  # for concise code
 
     fastq_folder = os.path.join(outfolder, "fastq")
+    scratch_folder = _scratch_folder(args, outfolder)
     if read2:
-        noadap_fastq = os.path.join(fastq_folder, sname + "_R2_noadap.fastq")
-        trimmed_fastq = os.path.join(fastq_folder, sname + "_R2_trimmed.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 2, "noadap")
+        trimmed_fastq = _fastq_path(fastq_folder, sname, 2, "trimmed")
     else:
-        noadap_fastq = os.path.join(fastq_folder,
-            sname + "_R1_noadap.fastq")
-        trimmed_fastq = os.path.join(fastq_folder,
-            sname + "_R1_processed.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 1, "noadap")
+        trimmed_fastq = _fastq_path(fastq_folder, sname, 1, "processed")
 
     fastp_folder = os.path.join(outfolder, "fastp")
     if read2:
@@ -619,27 +723,16 @@ def _trim_adapter_files(args, tools, read2, fq_file, outfolder):
         umi_report = os.path.join(fastp_folder, sname + "_R1_rmUmi.html")
         umi_json = os.path.join(fastp_folder, sname + "_R1_rmUmi.json")
 
-    # Check quality encoding for use with FastX_Tools
-    if args.trimmer == "fastx":
-        encoding = _guess_encoding(fq_file)
-    
+    noadap_input = "-" if stream else noadap_fastq
+
     if args.adapter == "fastp":
         # Remove UMI and specify location of UMI
         # Still requires seqtk for reverse complementation
-        if int(args.umi_len) > 0:
-            trim_cmd_chunks = [
-                tools.fastp,
-                ("--thread", str(pm.cores)),
-                ("-i", noadap_fastq),
-                "--stdout",
-                "--umi",
-                ("--umi_loc", "read1"),
-                ("--umi_len", args.umi_len),
-                ("--html", umi_report),
-                ("--json", umi_json)
-            ]
+        if args.umi_len > 0:
+            trim_cmd_chunks = _fastp_umi_chunks(
+                args, tools, noadap_input, umi_report, umi_json)
 
-            if int(args.max_len) > 0:
+            if args.max_len > 0:
                 # Trim to max length if specified
                 trim_cmd_chunks.extend([
                     "|",
@@ -647,160 +740,41 @@ def _trim_adapter_files(args, tools, read2, fq_file, outfolder):
                     ("-L", args.max_len),
                     "-"
                 ])
-
-        elif int(args.max_len) > 0:
+            trim_cmd_chunks.append("|")
+            seq_input = "-"
+        elif args.max_len > 0:
             trim_cmd_chunks = [
                 (tools.seqtk, "trimfq"),
                 ("-L", args.max_len),
-                noadap_fastq
+                noadap_input,
+                "|"
             ]
+            seq_input = "-"
         else:
+            # If no UMI removal or read trimming, just reverse complement
+            # and remove too short reads
             trim_cmd_chunks = []
+            seq_input = noadap_input
 
-        if trim_cmd_chunks:
-            # Reverse complement for PRO-seq
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5)
-                ("-L",(2 + int(float(args.umi_len))))
-            ])
-            if args.protocol.lower() in RUNON_SOURCE_PRO:
-                trim_cmd_chunks.extend([("-r", "-")])
-            else:
-                trim_cmd_chunks.extend(["-"])
-
-            trim_cmd_chunks.extend([(">", trimmed_fastq)])
+        trim_cmd_chunks.extend(
+            _size_and_orient(args, tools, seq_input, trimmed_fastq))
 
-        else:
-            # If no UMI removal or read trimming, just reverse complement
-            if args.protocol.lower() in RUNON_SOURCE_PRO:
-                trim_cmd_chunks.extend([
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    ("-r", noadap_fastq),
-                    (">", trimmed_fastq)
-                ])
-            # Otherwise just make sure to remove too short reads
-            else:
-                trim_cmd_chunks = [
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    noadap_fastq,
-                    (">", trimmed_fastq)
-                ]
-    elif args.trimmer == "seqtk":
-        # Remove UMI blindly by position
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq",
-            ("-b", str(args.umi_len))
-        ]
-
-        # Trim tp max length if specified
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([
-                ("-L", str(args.max_len))
-            ])
-        
-        trim_cmd_chunks.extend([noadap_fastq])
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                "-",
-                (">", trimmed_fastq)
-            ])
-        else:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-r", "-"),
-                (">", trimmed_fastq)
-            ])
     elif args.trimmer == "fastx":
-        trim_tool = tools.fastx + "_trimmer"
-        rc_tool = tools.fastx + "_reverse_complement"
-        trim_cmd_chunks = [trim_tool]
-        if encoding == "Illumina-1.8":
-            trim_cmd_chunks.extend([
-                ("-Q", str(33))
-            ])
-
-        # Remove UMI blindly by position only
-        trim_cmd_chunks.extend([
-            ("-f", str(int(float(args.umi_len)) + 1))
-        ])
-
-        # Trim tp max length if specified
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([
-                ("-l", (str(int(float(args.max_len)) +
-                 int(float(args.umi_len)))))
-            ])
-
-        # Remove too short reads
-        trim_cmd_chunks.extend([("-m", (2 + int(float(args.umi_len))))])
-
+        # Check quality encoding for use with FastX_Tools
+        encoding = _guess_encoding(fq_file)
         # Need undeduplicated results for complexity calculation
-        trim_cmd_chunks.extend([
-            ("-i", noadap_fastq)
-        ])
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                ("-o", trimmed_fastq)
-            ])
-        else:
-            trim_cmd_chunks.extend([("|", rc_tool)])
-            if encoding == "Illumina-1.8":
-                trim_cmd_chunks.extend([
-                    ("-Q", str(33))
-                ])
-            trim_cmd_chunks.extend([("-o", trimmed_fastq)])
+        trim_cmd_chunks = _fastx_trim(args, tools, encoding,
+                                      None if stream else noadap_fastq,
+                                      trimmed_fastq)
     else:
         # Default to seqtk
         # Remove UMI blindly by position only
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq",
-            ("-b", str(args.umi_len))
-        ]
-
-        # Trim to max length if specified
-        if int(args.max_len) > 0:
-            trim_cmd_chunks.extend([
-                ("-L", str(args.max_len))
-            ])
-
-        trim_cmd_chunks.extend([noadap_fastq])
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            # Do not reverse complement
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                "-",
-                (">", trimmed_fastq)
-            ])
-        else:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-r", "-"),
-                (">", trimmed_fastq)
-            ])
+        trim_cmd_chunks = _seqtk_trim_chunks(args, tools, noadap_input)
+        trim_cmd_chunks.extend(
+            _size_and_orient(args, tools, "-", trimmed_fastq))
 
     trim_cmd = build_command(trim_cmd_chunks)
-    pm.debug("trim_cmd_nodedup: {}".format(build_command(trim_cmd_chunks)))
+    pm.debug("trim_cmd_nodedup: {}".format(trim_cmd))
 
     return trim_cmd
 
@@ -820,20 +794,17 @@ def _trim_pipes(args, tools, read2, fq_file, outfolder):
     :return str: command to trim adapter trimmed and deduplicated reads
     """
 
-    # Only call this when NOT args.complexity or NOT int(args.umi_len) > 0
+    # Only call this when NOT args.complexity or NOT args.umi_len > 0
     sname = args.sample_name  # for concise code
 
     fastq_folder = os.path.join(outfolder, "fastq")
+    scratch_folder = _scratch_folder(args, outfolder)
     if read2:
-        noadap_fastq = os.path.join(fastq_folder,
-            sname + "_R2_noadap.fastq")
-        processed_fastq = os.path.join(fastq_folder,
-            sname + "_R2_trimmed.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 2, "noadap")
+        processed_fastq = _fastq_path(fastq_folder, sname, 2, "trimmed")
     else:
-        noadap_fastq = os.path.join(fastq_folder,
-            sname + "_R1_noadap.fastq")
-        processed_fastq = os.path.join(fastq_folder,
-            sname + "_R1_processed.fastq")
+        noadap_fastq = _fastq_path(scratch_folder, sname, 1, "noadap")
+        processed_fastq = _fastq_path(fastq_folder, sname, 1, "processed")
 
     fastp_folder = os.path.join(outfolder, "fastp")
     if read2:
@@ -843,194 +814,52 @@ def _trim_pipes(args, tools, read2, fq_file, outfolder):
         umi_report = os.path.join(fastp_folder, sname + "_R1_rmUmi.html")
         umi_json = os.path.join(fastp_folder, sname + "_R1_rmUmi.json")
 
-    # Check quality encoding for use with FastX_Tools
-    if args.trimmer == "fastx":
-        encoding = _guess_encoding(fq_file)
-
     if args.adapter == "fastp":
         # There are no intermediate files, just pipes
         # Remove UMI
-        if int(args.umi_len) > 0:
-            trim_cmd_chunks = [
-                tools.fastp,
-                ("--thread", str(pm.cores)),
-                ("--stdin", "--stdout"),
-                "--umi",
-                ("--umi_loc", "read1"),
-                ("--umi_len", args.umi_len),
-                ("--html", umi_report),
-                ("--json", umi_json),
-                "|",
-                (tools.seqtk, "trimfq")
-            ]
+        if args.umi_len > 0:
+            trim_cmd_chunks = _fastp_umi_chunks(
+                args, tools, "-", umi_report, umi_json)
+            trim_cmd_chunks.extend(["|", (tools.seqtk, "trimfq")])
 
             # Trim to max length if specified
-            if int(args.max_len) > 0:
+            if args.max_len > 0:
                 trim_cmd_chunks.extend([("-L", args.max_len)])
-
-            trim_cmd_chunks.extend(["-"])
-
-            # Do not reverse complement for GRO-seq
-            if args.protocol.lower() in RUNON_SOURCE_GRO:
-                trim_cmd_chunks.extend([
-                    "|",
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    "-",
-                    (">", processed_fastq)
-                ])
-            else:
-                trim_cmd_chunks.extend([
-                    "|",
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    ("-r", "-"),
-                    (">", processed_fastq)
-                ])
-        elif int(args.max_len) > 0:
-            # No UMI, but still trim max length
-            trim_cmd_chunks = [
-                (tools.seqtk, "trimfq"),
-                ("-L", args.max_len),
-                "-"
-            ]
-            # Do not reverse complement for GRO-seq
-            if args.protocol.lower() in RUNON_SOURCE_GRO:
-                trim_cmd_chunks.extend([
-                    "|",
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    "-",
-                    (">", processed_fastq)
-                ])
-            else:
-                trim_cmd_chunks.extend([
-                    "|",
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    ("-r", "-"),
-                    (">", processed_fastq)
-                ])
-        else:
-            # No UMI and no trimming
-            if args.protocol.lower() in RUNON_SOURCE_PRO:
-                trim_cmd_chunks = [
-                    (tools.seqtk, "seq"),
-                    #("-L", 5),
-                    ("-L",(2 + int(float(args.umi_len)))),
-                    ("-r", noadap_fastq),
-                    (">", processed_fastq)
-                ]
-            else:
-                trim_cmd_chunks = []
-    # if not args.complexity and int(args.umi_len) > 0 retain intermediate files
-    elif args.trimmer == "seqtk":
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq"
-        ]
-
-        if read2:
-            trim_cmd_chunks.extend([("-e", str(args.umi_len))])
-        else:
-            trim_cmd_chunks.extend([("-b", str(args.umi_len))])
-            if int(args.max_len) > 0:
-                trim_cmd_chunks.extend([("-L", str(args.max_len))])
-
-        trim_cmd_chunks.extend(["-"])
-
-        # Do not reverse complement for GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                "-",
-                (">", processed_fastq)
-            ])
-        else:
-            trim_cmd_chunks.extend([
-                "|",
-                tools.seqtk,
-                ("seq", "-r"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-", ">"),
-                processed_fastq
-            ])
-    elif args.trimmer == "fastx":
-        trim_tool = tools.fastx + "_trimmer"
-        rc_tool = tools.fastx + "_reverse_complement"
-        trim_cmd_chunks = [trim_tool]
-
-        if encoding == "Illumina-1.8":
-            trim_cmd_chunks.extend([("-Q", str(33))])
-
-        if read2:
-            trim_cmd_chunks.extend([("-t", str(int(float(args.umi_len))))])
-        else:
-            trim_cmd_chunks.extend([("-f", str(int(float(args.umi_len)) + 1))])
-            if int(args.max_len) > 0:
-                trim_cmd_chunks.extend([
-                    ("-l", (str(int(float(args.max_len)) +
-                     int(float(args.umi_len)))))
-                ])
-
-        # Remove too short reads
-        trim_cmd_chunks.extend([("-m", (2 + int(float(args.umi_len))))])
-
-        # Do not reverse complement for GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([("-o", processed_fastq)])                        
-        else:
-            trim_cmd_chunks.extend([("|", rc_tool)])
-            if encoding == "Illumina-1.8":
-                trim_cmd_chunks.extend([("-Q", str(33))])
-            trim_cmd_chunks.extend([("-o", processed_fastq)])
-    else:
-        # Default to seqtk
-        trim_cmd_chunks = [
-            tools.seqtk,
-            "trimfq"
-        ]
-
-        if read2:
-            trim_cmd_chunks.extend([("-e", str(args.umi_len))])
-        else:
-            trim_cmd_chunks.extend([("-b", str(args.umi_len))])
-            if int(args.max_len) > 0:
-                trim_cmd_chunks.extend([("-L", str(args.max_len))])
-
-        trim_cmd_chunks.extend(["-"])
-
-        # Do not reverse complement for GRO-seq
-        if args.protocol.lower() in RUNON_SOURCE_GRO:
-            trim_cmd_chunks.extend([
-                "|",
-                (tools.seqtk, "seq"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
+
+            trim_cmd_chunks.extend(["-", "|"])
+            trim_cmd_chunks.extend(
+                _size_and_orient(args, tools, "-", processed_fastq))
+        elif args.max_len > 0:
+            # No UMI, but still trim max length
+            trim_cmd_chunks = [
+                (tools.seqtk, "trimfq"),
+                ("-L", args.max_len),
                 "-",
-                (">", processed_fastq)
-            ])
+                "|"
+            ]
+            trim_cmd_chunks.extend(
+                _size_and_orient(args, tools, "-", processed_fastq))
         else:
-            trim_cmd_chunks.extend([
-                "|",
-                tools.seqtk,
-                ("seq", "-r"),
-                #("-L", 5),
-                ("-L",(2 + int(float(args.umi_len)))),
-                ("-", ">"),
-                processed_fastq
-            ])
+            # No UMI and no trimming
+            if args.protocol.lower() in RUNON_SOURCE_PRO:
+                trim_cmd_chunks = _size_and_orient(
+                    args, tools, noadap_fastq, processed_fastq)
+            else:
+                trim_cmd_chunks = []
+    # if not args.complexity and args.umi_len > 0 retain intermediate files
+    elif args.trimmer == "fastx":
+        # Check quality encoding for use with FastX_Tools
+        encoding = _guess_encoding(fq_file)
+        trim_cmd_chunks = _fastx_trim(args, tools, encoding,
+                                      None, processed_fastq, read2=read2)
+    else:
+        # Default to seqtk
+        trim_cmd_chunks = _seqtk_trim_chunks(args, tools, "-", read2=read2)
+        trim_cmd_chunks.extend(
+            _size_and_orient(args, tools, "-", processed_fastq))
 
     trim_cmd = build_command(trim_cmd_chunks)
-    pm.debug("trim_pipes_cmd: {}".format(build_command(trim_cmd_chunks)))
+    pm.debug("trim_pipes_cmd: {}".format(trim_cmd))
     pm.debug("trim_pipes_cmd read2 status: {}".format(read2))
 
     return trim_cmd
@@ -1064,16 +893,17 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
 
     preprocessed_fq1 = os.path.join(fastq_folder, sname + "_R1.fastq")
     preprocessed_fq2 = os.path.join(fastq_folder, sname + "_R2.fastq")
-    noadap_fq1 = os.path.join(fastq_folder, sname + "_R1_noadap.fastq")
-    noadap_fq2 = os.path.join(fastq_folder, sname + "_R2_noadap.fastq")
-    short_fq1 = os.path.join(fastq_folder, sname + "_R1_short.fastq")
-    short_fq2 = os.path.join(fastq_folder, sname + "_R2_short.fastq")
-    dedup_fq = os.path.join(fastq_folder, sname + "_R1_dedup.fastq")
-    trimmed_fq1 = os.path.join(fastq_folder, sname + "_R1_trimmed.fastq")
-    trimmed_fq2 = os.path.join(fastq_folder, sname + "_R2_trimmed.fastq")
-    trimmed_dups_fq2 = os.path.join(fastq_folder,
-        sname + "_R2_trimmed_dups.fastq")
-    processed_fastq = os.path.join(fastq_folder, sname + "_R1_processed.fastq")
+    scratch_folder = _scratch_folder(args, outfolder)
+    noadap_fq1 = _fastq_path(scratch_folder, sname, 1, "noadap")
+    noadap_fq2 = _fastq_path(scratch_folder, sname, 2, "noadap")
+    short_fq1 = _fastq_path(fastq_folder, sname, 1, "short")
+    short_fq2 = _fastq_path(fastq_folder, sname, 2, "short")
+    dedup_fq = _fastq_path(scratch_folder, sname, 1, "dedup")
+    dedup_log = os.path.join(fastq_folder, sname + "_R1_dedup.log")
+    trimmed_fq1 = _fastq_path(fastq_folder, sname, 1, "trimmed")
+    trimmed_fq2 = _fastq_path(fastq_folder, sname, 2, "trimmed")
+    trimmed_dups_fq2 = _fastq_path(fastq_folder, sname, 2, "trimmed_dups")
+    processed_fastq = _fastq_path(fastq_folder, sname, 1, "processed")
 
     if args.adapter == "cutadapt":
         cutadapt_folder = os.path.join(outfolder, "cutadapt")
@@ -1089,19 +919,38 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
                                       sname + "_R1_rmAdapter.txt")
 
     fastp_pfx = os.path.join(fastp_folder, sname + "_R1_fastp_adapter")
-    fastp_report_txt = fastp_pfx + ".txt"
     fastp_report_html = fastp_pfx + ".html"
+    fastp_report_json = fastp_pfx + ".json"
 
-    adapter_command = _remove_adapters(args, res, tools, read2, fq_file, outfolder)
+    # Without deduplication or the paired-end fragment plot, single-end fastp
+    # runs can trim and orient the reads in the same pass
+    fastp_only = (args.adapter == "fastp" and not args.paired_end and
+                  (args.complexity or args.umi_len <= 0))
+    adapter_command = _remove_adapters(args, res, tools, read2, fq_file,
+                                       outfolder, trim=fastp_only)
     pm.debug("Adapter command: {}".format(adapter_command))
     pm.debug("Read2 status: {}".format(read2))
 
     # To plot fragment sizes requires keeping intermediate files
-    if not args.complexity and int(args.umi_len) > 0:
-        deduplicate_command = _deduplicate(args, tools, fq_file, outfolder)
+    if not args.complexity and args.umi_len > 0:
+        # seqkit and dedup_fastq log how many duplicates they remove, so
+        # their output can be piped straight into trimming
+        stream_dedup = args.dedup in ["seqkit", "dedup_fastq"]
+        # They also read their input once, front to back, so the adapter
+        # trimmed reads can be split with tee into both pipelines
+        noadap_fifo = os.path.join(scratch_folder, sname + "_R1_noadap.fifo")
+        deduplicate_command = _deduplicate(
+            args, tools, fq_file, outfolder, stream=stream_dedup,
+            input_fastq="-" if stream_dedup else None)
         pm.debug("Dedup command: {}".format(deduplicate_command))
-        trim_command = _trim_adapter_files(args, tools, read2, fq_file, outfolder)
-        trim_command2 = _trim_deduplicated_files(args, tools, fq_file, outfolder)
+        # read2 is trimmed on its own, straight from its adapter trimmed file
+        trim_command = _trim_adapter_files(args, tools, read2, fq_file,
+                                           outfolder,
+                                           stream=stream_dedup and not read2)
+        trim_command2 = _trim_deduplicated_files(args, tools, fq_file,
+                                                 outfolder, stream=stream_dedup)
+    elif fastp_only:
+        trim_command = None
     else:
         trim_command = _trim_adapter_files(args, tools, read2, fq_file, outfolder)
 
@@ -1111,87 +960,56 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
         """
         if args.adapter == "cutadapt":
             report = cutadapt_report
-            adapter_term = "Reads with adapters:"
-            #too_short_term = "Reads that were too short:"
-            total_bases_term = "Total basepairs processed:"
-
-            ac_cmd = ("grep '" + adapter_term + "' " +
-                      report + " | awk '{print $(NF-1)}'")
-            # cutadapt version < 2.9
-            #ts_cmd = ("grep '" + too_short_term + "' " +
-            #          report + " | awk '{print $(NF-1)}'")
-            ts_cmd = "wc -l "
-            if read2:
-                ts_cmd += short_fq2
-            else:
-                ts_cmd += short_fq1
-            ts_cmd += " | awk '{print $1}'"
-            bases = ("grep '" + total_bases_term + "' " +
-                     report + " | awk '{print $(NF-1)}'")
-            adapter_bases = ("awk '{sum+=$1*$2} END {printf \"%.0f\", sum}' " +
-                             report)
-
         else:  # default to fastp
-            report = fastp_report_txt
-            adapter_term = "reads with adapter trimmed:"
-            too_short_term = "reads failed due to too short:"
-            total_bases_term = "total bases:"
-
-            ac_cmd = ("grep '" + adapter_term + "' " +
-                       report + " | head -n 1 | awk '{print $NF}'")
-            ts_cmd = ("grep '" + too_short_term + "' " +
-                       report + " | head -n 1 | awk '{print $NF}'")
-            bases = ("grep '" + total_bases_term + "' " +
-                     report + " | head -n 1 | awk '{print $NF}'")
-            adapter_bases = ("grep 'bases trimmed due to adapters:' " +
-                             report + " | awk '{print $NF}'")
-
+            report = fastp_report_json
             pm.report_object("FastP_report", fastp_report_html)
 
         if _itsa_file(report):
-            tmp = pm.checkprint(ac_cmd)
-            if tmp:
-                ac = float(tmp.replace(',',''))
+            if args.adapter == "cutadapt":
+                ac = _parse_cutadapt_report(report)
+                # Count the reads cutadapt set aside as too short
+                short_fq = short_fq2 if read2 else short_fq1
+                if _itsa_file(short_fq):
+                    ts = float(ngstk.count_lines(short_fq).strip())/4
+                else:
+                    ts = 0
             else:
-                ac = 0
+                ac, ts = _parse_fastp_json(report)
             pm.report_result("Reads_with_adapter", ac)
             
-            tmp = pm.checkprint(bases)
-            if tmp:
-                total_bases = float(tmp.replace(',',''))
-            else:
-                total_bases = 0
-                
-            tmp = pm.checkprint(adapter_bases)
-            if tmp:
-                total_adapter = float(tmp.replace(',',''))
-            else:
-                total_adapter = 0
-            
-            tmp = pm.checkprint(ts_cmd)
-            if tmp:
-                ts = float(tmp.replace(',',''))
-                if args.adapter == "cutadapt":
-                    ts = ts/4
-            else:
-                ts = 0
-            
             pm.report_result("Uninformative_adapter_reads", round(ts, 2))
 
-            if _itsa_file(noadap_fq1):
-                tr = int(ngstk.count_lines(noadap_fq1).strip())
-            else:
-                tr = 0
-
             if _itsa_file(dedup_fq):
+                # Only needed to count duplicates; skip the scan otherwise
+                if _itsa_file(noadap_fq1):
+                    tr = int(ngstk.count_lines(noadap_fq1).strip())
+                else:
+                    tr = 0
                 dr = int(ngstk.count_lines(dedup_fq).strip())
                 dups = max(0, (float(tr)/4 - float(dr)/4))
                 pm.report_result("Duplicate_reads", round(dups, 2))
-
-            if _itsa_file(preprocessed_fq1):
-                pre = int(ngstk.count_lines(preprocessed_fq1).strip())
+            elif _itsa_file(dedup_log):
+                # Deduplicated reads were streamed into trimming
+                with open(dedup_log) as f:
+                    for line in f:
+                        if "duplicated records removed" in line:
+                            dups = int(line.split("duplicated")[0].split()[-1])
+                            pm.report_result("Duplicate_reads", dups)
+                            break
+
+            # Fastq_reads already counts the R1 file (twice over for PE)
+            fastq_reads = pm.get_stat("Fastq_reads")
+            if fastq_reads:
+                pre_reads = float(fastq_reads)
+                if args.paired_end:
+                    pre_reads = pre_reads/2
+            elif _itsa_file(preprocessed_fq1):
+                pre_reads = float(ngstk.count_lines(preprocessed_fq1).strip())/4
+            else:
+                pre_reads = 0
+            if pre_reads:
                 pm.report_result("Pct_uninformative_adapter_reads", 
-                    round(float(100*(ts/(float(pre)/4))), 4))
+                    round(float(100*(ts/pre_reads)), 4))
         else:
             pm.fail_pipeline("Could not find '{}' to report adapter "
                              "removal statistics.".format(report))
@@ -1259,7 +1077,7 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
             args.sample_name + "_adapter_insertion_distribution.png")
         cmd = (tools.Rscript + " " + tool_path("PEPPRO.R") + 
                " adapt -i " + flash_hist + " -o " + outfolder)
-        if int(args.umi_len) > 0:
+        if args.umi_len > 0:
             cmd += (" -u " + str(args.umi_len))
             umi_len = args.umi_len
         else:
@@ -1268,86 +1086,69 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
         pm.report_object("Adapter insertion distribution", degradation_pdf,
                          anchor_image=degradation_png)
 
-        if not pm.get_stat('Peak_adapter_insertion_size') or args.new_start:
-            # Report the peak insertion size
-            cmd = ("awk 'NR>2 {print prev} {prev=$0}' " + flash_hist + 
-                   " | awk 'BEGIN{max=   0; max_len=0; len=0}{if ($2>0+max)" +
-                   " {max=$2; len=$1}; max_len=$1} END{print len-" +
-                   str(umi_len) + "}'")
-            adapter_peak = pm.checkprint(cmd)
-            if adapter_peak:
-                ap = int(adapter_peak)
-                pm.report_result("Peak_adapter_insertion_size", ap)
+        # The histogram is small; read it once for both statistics below
+        # rather than running awk over it for every value
+        if (not pm.get_stat('Peak_adapter_insertion_size') or
+                not pm.get_stat('Degradation_ratio') or args.new_start):
+            insertions = []
+            if os.path.isfile(flash_hist):
+                with open(flash_hist) as hist:
+                    for line in hist:
+                        fields = line.split()
+                        if len(fields) >= 2:
+                            insertions.append(
+                                (int(fields[0]) - umi_len, int(fields[1])))
+
+        else:
+            insertions = []
+
+        if insertions and (not pm.get_stat('Peak_adapter_insertion_size') or
+                           args.new_start):
+            # Report the peak insertion size, ignoring the first and last
+            # (catch-all) histogram rows
+            ap = -umi_len
+            max_count = 0
+            for length, count in insertions[1:-1]:
+                if count > max_count:
+                    max_count = count
+                    ap = length
+            pm.report_result("Peak_adapter_insertion_size", ap)
 
         # Report the degradation ratio
-        if not pm.get_stat('Degradation_ratio') or args.new_start:
+        if insertions and (not pm.get_stat('Degradation_ratio') or
+                           args.new_start):
             pm.timestamp("###  Calculating degradation ratio")
 
-            cmd = ("awk '{ if (($1-" + str(umi_len) + ") == 10) {status = 1}} " + 
-                   "END {if (status) {print status} else {print 0}}' " +
-                   flash_hist)
-            degraded_lower = pm.checkprint(cmd)
-            cmd = ("awk '{ if (($1-" + str(umi_len) + ") == 20) {status = 1}} " + 
-                   "END {if (status) {print status} else {print 0}}' " +
-                   flash_hist)
-            degraded_upper = pm.checkprint(cmd)
-            cmd = ("awk '{ if (($1-" + str(umi_len) + ") == 30) {status = 1}} " + 
-                   "END {if (status) {print status} else {print 0}}' " +
-                   flash_hist)
-            intact_lower = pm.checkprint(cmd)
-            cmd = ("awk '{ if (($1-" + str(umi_len) + ") == 40) {status = 1}} " + 
-                   "END {if (status) {print status} else {print 0}}' " +
-                   flash_hist)
-            intact_upper = pm.checkprint(cmd)
-
-            if degraded_lower:
-                dl = int(degraded_lower)
-            if dl == 1:
+            # The bounds are chosen exactly as the original awk chain chose
+            # them, 0/1 "bin present" flags and fallbacks included, so the
+            # reported ratio is unchanged
+            lengths = set(length for length, _ in insertions)
+            first = insertions[0][0]
+            last = insertions[-1][0]
+            if 10 in lengths:
                 dl = 10
+                du = 20 if 20 in lengths else 11
             else:
-                cmd = ("awk 'NR==1 {print ($1-" + str(umi_len) + ")}' " + flash_hist)
-                degraded_lower = pm.checkprint(cmd)
-                dl = int(degraded_lower) if degraded_lower else 1
-                if dl < 1:
-                    dl = 1
-
-            if degraded_upper:
-                du = int(degraded_upper)
-            if du == 1:
-                du = 20
-            else:
-                du = int(degraded_lower) + 10
+                dl = max(first, 1)
+                du = 20 if 20 in lengths else first + 10
 
-            if intact_upper:
-                iu = int(intact_upper)
-            if iu == 1:
+            if 40 in lengths:
                 iu = 40
-            else:
-                cmd = ("awk 'END {print ($1-" + str(umi_len) + ")}' " + flash_hist)
-                intact_upper = pm.checkprint(cmd)
-                dl = int(intact_upper) if intact_upper else 40
-
-            if intact_lower:
-                il = int(intact_lower)
-            if il == 1:
                 il = 30
             else:
-                il = int(intact_upper) - 10
+                iu = 0
+                dl = last
+                il = 30 if 30 in lengths else last - 10
                 if il < 1:
                     il = 30
 
-            cmd = ("awk '(($1-" + str(umi_len) + " ) <= " + str(du) +
-                   " && ($1-" + str(umi_len) + " ) >= " + str(dl) +
-                   "){degradedSum += $2}; " +  "(($1-" + str(umi_len) +
-                   " ) >= " + str(il) + " && ($1-" + str(umi_len) +
-                   ") <= " + str(iu) +
-                   "){intactSum += $2}  END {if (intactSum < 1) " +
-                   "{intactSum = 1} print degradedSum/intactSum}' "
-                   + flash_hist)
-            degradation_ratio = pm.checkprint(cmd)
-            if degradation_ratio:
-                dr = float(degradation_ratio)
-                pm.report_result("Degradation_ratio", round(dr, 4))
+            degraded_sum = sum(count for length, count in insertions
+                               if dl <= length <= du)
+            intact_sum = sum(count for length, count in insertions
+                             if il <= length <= iu)
+            # awk printed the ratio with six significant digits
+            dr = float("%.6g" % (float(degraded_sum) / max(intact_sum, 1)))
+            pm.report_result("Degradation_ratio", round(dr, 4))
 
 
     def check_trim(trimmed_fastq, paired_end,
@@ -1364,52 +1165,45 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
         :return callable: Function to evaluate read trimming and possibly run
             fastqc.
         """
-        n_trim = float(ngstk.count_reads(trimmed_fastq, paired_end))
-        pm.report_result("Trimmed_reads_R1", int(n_trim))
-
-        try:
-            rr = float(pm.get_stat("Raw_reads"))
-        except:
-            print("Can't calculate trim loss rate without raw read result.")
-        else:
-            pm.report_result("Trim_loss_rate_R1",
-                             round((rr - n_trim) * 100 / rr, 2))
-
+        # Count the trimmed reads in the background while fastqc, which
+        # reads the same files, runs in the foreground
+        trimmed = [("R1", trimmed_fastq)]
         if paired_end and trimmed_fastq_R2:
-            n_trim = float(ngstk.count_reads(trimmed_fastq_R2, paired_end))
-            pm.report_result("Trimmed_reads_R2", int(n_trim))
+            trimmed.append(("R2", trimmed_fastq_R2))
+        with ThreadPoolExecutor(max_workers=len(trimmed)) as executor:
+            counts = [executor.submit(ngstk.count_reads, fastq, paired_end)
+                      for _, fastq in trimmed]
+
+            # Also run a fastqc (if installed/requested)
+            if fastqc_folder:
+                if fastqc_folder and os.path.isabs(fastqc_folder):
+                    try:
+                        os.makedirs(fastqc_folder)
+                    except OSError as exception:
+                        if exception.errno != errno.EEXIST:
+                            raise
+                for read, fastq in trimmed:
+                    cmd = ngstk.fastqc(fastq, fastqc_folder)
+                    lock_name = ("trimmed_fastqc" if read == "R1" else
+                                 "trimmed_fastqc_R2")
+                    pm.run(cmd, lock_name=lock_name, nofail=True)
+                    fname, ext = os.path.splitext(os.path.basename(fastq))
+                    fastqc_html = os.path.join(
+                        fastqc_folder, fname + "_fastqc.html")
+                    pm.report_object("FastQC report " + read, fastqc_html)
+
+        for (read, _), count in zip(trimmed, counts):
+            n_trim = float(count.result())
+            pm.report_result("Trimmed_reads_" + read, int(n_trim))
 
             try:
                 rr = float(pm.get_stat("Raw_reads"))
             except:
                 print("Can't calculate trim loss rate without raw read result.")
             else:
-                pm.report_result("Trim_loss_rate_R2",
+                pm.report_result("Trim_loss_rate_" + read,
                                  round((rr - n_trim) * 100 / rr, 2))
 
-        # Also run a fastqc (if installed/requested)
-        if fastqc_folder:
-            if fastqc_folder and os.path.isabs(fastqc_folder):
-                try:
-                    os.makedirs(fastqc_folder)
-                except OSError as exception:
-                    if exception.errno != errno.EEXIST:
-                        raise
-            cmd = ngstk.fastqc(trimmed_fastq, fastqc_folder)
-            pm.run(cmd, lock_name="trimmed_fastqc", nofail=True)
-            fname, ext = os.path.splitext(os.path.basename(trimmed_fastq))
-            fastqc_html = os.path.join(fastqc_folder, fname + "_fastqc.html")
-            pm.report_object("FastQC report R1", fastqc_html)
-            
-            if paired_end and trimmed_fastq_R2:
-                    cmd = ngstk.fastqc(trimmed_fastq_R2, fastqc_folder)
-                    pm.run(cmd, lock_name="trimmed_fastqc_R2", nofail=True)
-                    fname, ext = os.path.splitext(
-                        os.path.basename(trimmed_fastq_R2))
-                    fastqc_html = os.path.join(
-                        fastqc_folder, fname + "_fastqc.html")
-                    pm.report_object("FastQC report R2", fastqc_html)
-
     # Put it all together
     paired_end = args.paired_end
     if read2:
@@ -1425,22 +1219,54 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
             output_folder = os.path.join(outfolder, "fastp")
         cp_cmd = ("cp " + trimmed_fq2 + " " + trimmed_dups_fq2)
         pm.run(cp_cmd, trimmed_dups_fq2,
-               follow=plot_fragments(fastq_folder, output_folder))
+               follow=plot_fragments(scratch_folder, output_folder))
+        pm.clean_add(noadap_fq2)
         pm.clean_add(short_fq2)
         return trimmed_fq2, trimmed_dups_fq2
-    elif not args.complexity and int(args.umi_len) > 0:
+    elif not args.complexity and args.umi_len > 0:
         # This trim command DOES need the adapter file...
         pm.debug("\ntrim_command1: {} +\n {}\n".format(adapter_command, trim_command))
-        pm.run([adapter_command, trim_command], processed_fastq)
+        pm.debug("\ntrim_command2: {} +\n {}\n".format(deduplicate_command, trim_command2))
+        if stream_dedup:
+            # Read the adapter trimmed file once: tee feeds the
+            # deduplication pipeline through a named pipe while the
+            # plain trimming pipeline reads from stdin
+            if os.path.exists(noadap_fifo):
+                os.remove(noadap_fifo)
+            pm.run("mkfifo " + noadap_fifo, noadap_fifo)
+            # The split runs in one shell, where wait only sees the last
+            # command of the background pipeline; a flag file records a
+            # failed deduplication. The shell opens the named pipe for the
+            # deduplicator before starting it, so tee is never left waiting
+            # on a reader that died first
+            dedup_failed = os.path.join(scratch_folder,
+                                        sname + "_R1_dedup.failed")
+            if os.path.exists(dedup_failed):
+                os.remove(dedup_failed)
+            split_cmd = ("({ " + deduplicate_command + " || touch " +
+                         dedup_failed + "; } < " + noadap_fifo + " | " +
+                         trim_command2 +
+                         ") & p=$!; tee " + noadap_fifo + " < " +
+                         noadap_fq1 + " | " + trim_command + "; r=$?; " +
+                         "wait $p && [ $r -eq 0 ] && [ ! -e " +
+                         dedup_failed + " ]")
+            pm.run(adapter_command, [processed_fastq, trimmed_fq1])
+            pm.run(split_cmd, [processed_fastq, trimmed_fq1], shell=True,
+                   follow=report_fastq)
+            # pypiper only cleans up regular files
+            if os.path.exists(noadap_fifo):
+                os.remove(noadap_fifo)
+        else:
+            pm.run([adapter_command, trim_command], processed_fastq)
         if not _itsa_file(fastqc_report) or args.new_start:
             cmd = ("echo '### Calculated the number of trimmed reads'")
             pm.run(cmd, fastqc_report, 
                    follow=check_trim(processed_fastq, paired_end, None,
                                      fastqc_folder=fastqc_folder))
-        # This needs to produce the trimmed_fastq file
-        pm.debug("\ntrim_command2: {} +\n {}\n".format(deduplicate_command, trim_command2))
-        pm.run([deduplicate_command, trim_command2],
-               trimmed_fq1, follow=report_fastq)
+        if not stream_dedup:
+            # This needs to produce the trimmed_fastq file
+            pm.run([deduplicate_command, trim_command2], trimmed_fq1,
+                   follow=report_fastq)
         pm.clean_add(noadap_fq1)
         pm.clean_add(short_fq1)
         pm.clean_add(dedup_fq)
@@ -1448,8 +1274,11 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
         return processed_fastq, trimmed_fq1
     else:
         pm.debug("\nELSE: trim_command: {} + {}\n".format(adapter_command, trim_command))
-        pm.run([adapter_command, trim_command], processed_fastq,
-               follow=report_fastq)
+        if fastp_only:
+            pm.run(adapter_command, processed_fastq, follow=report_fastq)
+        else:
+            pm.run([adapter_command, trim_command], processed_fastq,
+                   follow=report_fastq)
         if not _itsa_file(fastqc_report) or args.new_start:
             cmd = ("echo '### Calculate the number of trimmed reads'")
             pm.run(cmd, fastqc_report, 
@@ -1462,7 +1291,8 @@ def _process_fastq(args, tools, res, read2, fq_file, outfolder):
 
 def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
                     assembly_identifier, assembly_bt2, outfolder,
-                    aligndir=None, bt2_opts_txt=None, dups=False):
+                    aligndir=None, bt2_opts_txt=None, dups=False,
+                    sort_tempdir=None):
     """
     A helper function to run alignments in series, so you can run one alignment
     followed by another; this is useful for successive decoy alignments.
@@ -1482,9 +1312,10 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
     :param str aligndir: name of folder for temporary output
     :param str bt2_opts_txt: command-line text for bowtie2 options
     :param bool dups: if True, produce alternative named output
+    :param str sort_tempdir: path to folder for samtools sort temporary files
     :return (str, str): pair (R1, R2) of paths to FASTQ files
     """
-    if os.path.exists(os.path.dirname(assembly_bt2)):
+    if _check_bowtie2_index(assembly_bt2):
         pm.timestamp("### Map to " + assembly_identifier)
         if not aligndir:
             align_subdir = "aligned_{}_{}".format(args.genome_assembly,
@@ -1494,12 +1325,15 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
             sub_outdir = os.path.join(outfolder, aligndir)
 
         ngstk.make_dir(sub_outdir)
+        aln_ext = ".cram" if args.cram else ".bam"
         if dups:
-            bamname = "{}_{}_dups.bam".format(args.sample_name, assembly_identifier)
+            bamname = "{}_{}_dups{}".format(args.sample_name,
+                                            assembly_identifier, aln_ext)
             summary_name = "{}_{}_bt_aln_dups_summary.log".format(args.sample_name,
                                                                   assembly_identifier)
         else:
-            bamname = "{}_{}.bam".format(args.sample_name, assembly_identifier)
+            bamname = "{}_{}{}".format(args.sample_name, assembly_identifier,
+                                       aln_ext)
             summary_name = "{}_{}_bt_aln_summary.log".format(args.sample_name,
                                                              assembly_identifier)
         mapped_bam = os.path.join(sub_outdir, bamname)
@@ -1508,17 +1342,16 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
         out_fastq_pre = os.path.join(
             sub_outdir, args.sample_name + "_" + assembly_identifier)
         if dups:
-            out_fastq_r1 = out_fastq_pre + '_unmap_dups_R1.fq'
-            out_fastq_r2 = out_fastq_pre + '_unmap_dups_R2.fq'
+            out_fastq_conc = out_fastq_pre + '_unmap_dups_R%.fq'
         else:
-            out_fastq_r1 = out_fastq_pre + '_unmap_R1.fq'
-            out_fastq_r2 = out_fastq_pre + '_unmap_R2.fq'
-
-        # Use the undeduplicated even for duplicates on re-runs
-        out_fastq_r1_gz = out_fastq_pre + '_unmap_R1.fq.gz'
-        out_fastq_r2_gz = out_fastq_pre + '_unmap_R2.fq.gz'
-
-        if useFIFO and paired and not args.keep:
+            out_fastq_conc = out_fastq_pre + '_unmap_R%.fq'
+        out_fastq_r1 = out_fastq_conc.replace('%', '1')
+        out_fastq_r2 = out_fastq_conc.replace('%', '2')
+
+        # Paired reads are aligned as pairs unless we keep the BAM; then the
+        # unmapped R1 reads are only consumed by filter_paired_fq, so
+        # stream them through a named pipe
+        if useFIFO and paired and args.keep:
             if dups:
                 out_fastq_tmp = os.path.join(sub_outdir,
                                              assembly_identifier + "_dups_bt2")
@@ -1540,8 +1373,13 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
 
         out_fastq_tmp_gz = out_fastq_pre + '_unmap.fq.gz'
 
-        filter_pair = build_command([tools.perl,
-            tool_path("filter_paired_fq.pl"), out_fastq_tmp,
+        # Prefer the compiled re-pairing helper (`make filter_paired_fq`)
+        filter_tool = tool_path("filter_paired_fq")
+        if os.access(filter_tool, os.X_OK):
+            filter_cmd = [filter_tool]
+        else:
+            filter_cmd = [tools.perl, tool_path("filter_paired_fq.pl")]
+        filter_pair = build_command(filter_cmd + [out_fastq_tmp,
             unmap_fq1, unmap_fq2, out_fastq_r1, out_fastq_r2])
         # TODO: make filter_paired_fq work with SE data
         # cmd = build_command([tools.perl,
@@ -1555,25 +1393,35 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
             bt2_opts_txt += " -D 20 -R 3 -N 1 -L 20 -i S,1,0.50"
 
         # samtools sort needs a temporary directory
-        tempdir = tempfile.mkdtemp(dir=sub_outdir)
-        os.chmod(tempdir, 0o771)
-        pm.clean_add(tempdir)
+        tempdir = tempfile.mkdtemp(dir=sort_tempdir)
 
         # Build bowtie2 command
         cmd = "(" + tools.bowtie2 + " -p " + str(pm.cores)
         cmd += " " + bt2_opts_txt
         cmd += " -x " + assembly_bt2
         cmd += " --rg-id " + args.sample_name
-        cmd += " -U " + unmap_fq1
-        cmd += " --un " + out_fastq_tmp
+        if paired and not args.keep:
+            # bowtie2 writes pairs that fail to align concordantly,
+            # so there is nothing to re-pair afterwards
+            cmd += " --rf -1 " + unmap_fq1 + " -2 " + unmap_fq2
+            cmd += " --un-conc " + out_fastq_conc
+        else:
+            cmd += " -U " + unmap_fq1
+            cmd += " --un " + out_fastq_tmp
         if args.keep: #  or not paired
             #cmd += " --un-gz " + out_fastq_bt2 # TODO drop this for paired... because repairing with filter_paired_fq.pl
             # In this samtools sort command we print to stdout and then use > to
             # redirect instead of  `+ " -o " + mapped_bam` because then samtools
             # uses a random temp file, so it won't choke if the job gets
             # interrupted and restarted at this step.
-            cmd += " | " + tools.samtools + " view -bS - -@ 1"  # convert to bam
-            cmd += " | " + tools.samtools + " sort - -@ 1"  # sort output
+            # samtools sort reads SAM directly; no separate view to BAM needed
+            sort_threads = max(1, int(pm.cores) // 2)
+            cmd += " | " + tools.samtools + " sort - -@ " + str(sort_threads)
+            cmd += " -m 1G"
+            if args.cram:
+                # Decoy references aren't otherwise needed downstream, so
+                # store read sequences in full rather than against a fasta
+                cmd += " --output-fmt cram,version=3.1,no_ref=1"
             cmd += " -T " + tempdir
             cmd += " -o " + mapped_bam
             cmd += ") 2>&1"
@@ -1582,18 +1430,25 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
         #cmd += ")"
         #cmd += ") 2> " + summary_file
 
-        if paired:
-            if args.keep or not useFIFO:
+        aln_stats = None
+        if paired and not args.keep:
+            if (not (_itsa_file(out_fastq_r2) or
+                     _itsa_file(out_fastq_r2 + ".gz")) or args.new_start):
+                aln_stats = pm.checkprint(cmd)
+        elif paired:
+            if not useFIFO:
                 # checkprint() doesn't know how to handle targets
                 # must recreate that effect ourselves
                 if not _itsa_file(mapped_bam) or args.new_start:
                     aln_stats = pm.checkprint(cmd)
                 pm.run(filter_pair, mapped_bam)
             else:
+                # Launch the FIFO reader first, then the writer; both are
+                # keyed on the same target so neither runs without the other
                 pm.wait = False
-                pm.run(filter_pair, out_fastq_r2_gz)
+                pm.run(filter_pair, mapped_bam)
                 pm.wait = True
-                if not _itsa_file(out_fastq_r2_gz) or args.new_start:
+                if not _itsa_file(mapped_bam) or args.new_start:
                     aln_stats = pm.checkprint(cmd)
         else:
             if args.keep:
@@ -1615,17 +1470,12 @@ def _align_with_bt2(args, tools, paired, useFIFO, unmap_fq1, unmap_fq2,
                 if aln_stats:
                     pm.info(aln_stats)  # Log alignment statistics
                     try:
-                        align_exact = re.search(r".*aligned exactly 1 time", aln_stats).group().split()[0]
-                    except AttributeError:
-                        align_exact = None
-                    except:
+                        align_exact = _parse_bt2_exact1(aln_stats)
+                    except ValueError:
                         err_msg = "Unable to determine alignment statistics for {}."
                         pm.fail_pipeline(RuntimeError(err_msg.format(args.genome_assembly)))
                 else:
                     align_exact = None
-                # cmd = ("grep 'aligned exactly 1 time' " + summary_file +
-                #        " | awk '{print $1}'")
-                # align_exact = pm.checkprint(cmd)
 
                 if align_exact:
                     if paired:
@@ -1676,11 +1526,11 @@ def tool_path(tool_name):
     :return str: real, absolute path to tool (expansion and symlink resolution)
     """
 
-    return os.path.join(os.path.dirname(os.path.dirname(__file__)),
-                        TOOLS_FOLDER, tool_name)
+    return os.path.join(TOOLS_DIR, tool_name)
 
 
-def _guess_encoding(fq):
+@functools.lru_cache(maxsize=None)
+def _guess_encoding(fq, max_records=10000):
     """
     Adapted from Brent Pedersen's "_guess_encoding.py"
     https://github.com/brentp/bio-playground/blob/master/reads-utils/guess-encoding.py
@@ -1706,51 +1556,76 @@ def _guess_encoding(fq):
     SOFTWARE.
 
     Guess the encoding of a stream of qual lines.
-    """
-    RANGES = {
-        'Sanger': (33, 73),
-        'Illumina-1.8': (33, 74),
-        'Solexa': (59, 104),
-        'Illumina-1.3': (64, 104),
-        'Illumina-1.5': (67, 105)
-    }
-    
-    def get_qual_range(qual_str):
-        vals = [ord(c) for c in qual_str]
-        return min(vals), max(vals)
-    
-    def get_encodings_in_range(rmin, rmax, ranges=RANGES):
-        valid_encodings = []
-        for encoding, (emin, emax) in ranges.items():
-            if rmin >= emin and rmax <= emax:
-                valid_encodings.append(encoding)
-        return valid_encodings
 
+    :param str fq: path to FASTQ file
+    :param int max_records: maximum number of quality lines to inspect
+    :return str: name of the most likely quality encoding
+    """
     gmin = 99
     gmax = 0
     valid = []
 
     err_exit = False
+    n_records = 0
+
+    # Stream gzipped input directly rather than decompressing it to disk
+    proc = None
+    if is_gzipped(fq):
+        if shutil.which("pigz"):
+            proc = subprocess.Popen(["pigz", "-dc", fq],
+                                    stdout=subprocess.PIPE, bufsize=1 << 20)
+            fastq_file = proc.stdout
+        else:
+            fastq_file = gzip.open(fq, 'rb')
+    else:
+        fastq_file = open(fq, 'rb')
 
-    with open(fq) as fastq_file:
-        for line_num, line in enumerate(fastq_file):
-            # Python starts at 0; need to start at 1 for this step
-            if (line_num + 1) % 4 == 0:
-                lmin, lmax = get_qual_range(line.rstrip())
-
-                if lmin < gmin or lmax > gmax:
-                    gmin, gmax = min(lmin, gmin), max(lmax, gmax)
-                    valid = get_encodings_in_range(gmin, gmax)
-
-                    if len(valid) == 0:
-                        print("no encodings for range: "
-                              "{}".format((gmin, gmax)))
-                        err_exit = True
-                        continue
-
-                    if len(valid) == 1:
-                        err_exit = False
-                        break
+    try:
+        while not max_records or n_records < max_records:
+            # Reduce a batch of quality lines at once rather than per record
+            batch = QUAL_SCAN_BATCH
+            if max_records:
+                batch = min(batch, max_records - n_records)
+            lines = list(itertools.islice(fastq_file, 4 * batch))
+            quals = [line.rstrip() for line in lines[3::4]]
+            if not quals:
+                break
+            n_records += len(quals)
+            lens = np.array([len(qual) for qual in quals], dtype=np.int64)
+            lens = lens[lens > 0]
+            if not lens.size:
+                continue
+            vals = np.frombuffer(b"".join(quals), dtype=np.uint8)
+            starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+            # Running range after each record, as a per record scan sees it
+            cmin = np.minimum.accumulate(np.concatenate(
+                ([gmin], np.minimum.reduceat(vals, starts))))[1:]
+            cmax = np.maximum.accumulate(np.concatenate(
+                ([gmax], np.maximum.reduceat(vals, starts))))[1:]
+            in_range = ((cmin[:, None] >= QUAL_ENC_MINS) &
+                        (cmax[:, None] <= QUAL_ENC_MAXS))
+            # The range only widens, so the candidates only shrink; stop at
+            # the first record that leaves one encoding or none
+            decided = np.flatnonzero(in_range.sum(axis=1) <= 1)
+            last = decided[0] if decided.size else len(lens) - 1
+            gmin, gmax = int(cmin[last]), int(cmax[last])
+            valid = QUAL_ENCODINGS[in_range[last]].tolist()
+
+            if len(valid) == 0:
+                print("no encodings for range: "
+                      "{}".format((gmin, gmax)))
+                err_exit = True
+                break
+
+            if len(valid) == 1:
+                err_exit = False
+                break
+    finally:
+        fastq_file.close()
+        if proc:
+            # Only a prefix is read; don't wait on the full decompression
+            proc.kill()
+            proc.wait()
 
     if err_exit:
         return("Unknown")
@@ -1766,9 +1641,10 @@ def _check_commands(commands, ignore=''):
     :param list ignore: list of commands that are optional and can be ignored
     """
 
-    # Use `command` to see if command is callable, store exit code
+    # Walk the PATH in-process rather than forking a shell per command
     is_callable = True
     uncallable = []
+    java_callable = None
     for name, command in commands.items():
         if command not in ignore:
             # if an environment variable is not expanded it means it points to
@@ -1779,14 +1655,18 @@ def _check_commands(commands, ignore=''):
                 if not os.path.exists(command):
                     uncallable.append(command)
 
-            # if a command is a java file, modify the command
+            # if a command is a java file, it needs java and the jar itself
             if '.jar' in command:
+                if java_callable is None:
+                    java_callable = shutil.which("java") is not None
+                found = java_callable and os.path.isfile(command)
                 command = "java -jar " + command
+            else:
+                exe = command.split()[0] if command.split() else command
+                found = shutil.which(exe) is not None
 
-            code = os.system("command -v {0} >/dev/null 2>&1 || {{ exit 1; }}".format(command))
-            # If exit code is not 0, track which command failed
-            #print("{} code {}".format(command, code))  # DEBUG
-            if code != 0:
+            # Track which command failed
+            if not found:
                 uncallable.append(command)
                 is_callable = False
     if is_callable:
@@ -1822,6 +1702,425 @@ def calc_frip(bamfile, ftfile, frip_func, pipeline_manager,
     return float(num_in_reads) / float(num_aligned_reads)
 
 
+@functools.lru_cache(maxsize=None)
+def _tool_version(tool, env_var=None):
+    """
+    Get the version of a tool as a tuple of integers, e.g. (2, 10).
+
+    The result is cached so the tool is only invoked once per run; if env_var
+    names a set environment variable, its value is used instead.
+
+    :param str tool: command used to invoke the tool
+    :param str env_var: environment variable that may pin the version
+    :return tuple: version numbers, compared component-wise
+    """
+    version = os.environ.get(env_var) if env_var else None
+    if not version:
+        version = pm.checkprint(tool + " --version")
+    match = re.search(r"\d+(\.\d+)*", str(version))
+    if not match:
+        return ()
+    return tuple(int(v) for v in match.group(0).split("."))
+
+
+@functools.lru_cache(maxsize=None)
+def _check_bowtie2_index(assembly_bt2):
+    """
+    Helper function to confirm a bowtie2 index is present and not empty.
+
+    :param str assembly_bt2: path prefix of the bowtie2 index
+    :return bool: True if a complete small (.bt2) or large (.bt2l) index exists
+    """
+    bt2_path, bt2_prefix = os.path.split(assembly_bt2)
+    if not os.path.isdir(bt2_path):
+        return False
+
+    # Single directory pass; DirEntry caches the stat result
+    with os.scandir(bt2_path) as it:
+        entries = dict((e.name, e.stat().st_size) for e in it if e.is_file())
+    empty = set(name for name, size in entries.items() if size == 0)
+
+    for ext in ["", "l"]:
+        # Match file names exactly so .bt2 never matches .bt2l
+        bt_expected = set(bt2_prefix + sfx + ext for sfx in BT2_IDX_SUFFIXES)
+        if bt_expected <= entries.keys():
+            return not (bt_expected & empty)
+    return False
+
+
+def _split_prealignment(reference):
+    """
+    Helper function to split a prealignment argument into its parts.
+
+    :param str reference: prealignment genome and index delimited by an equals
+        sign, e.g. rCRSd=/path/to/bowtie2_index/.
+    :return (str, str): pair of genome name and bowtie2 index path prefix
+    """
+    genome, genome_index = reference.split('=')
+    if genome_index.endswith("."):
+        # Replace last occurrence of . with genome name
+        genome_index = genome_index[:genome_index.rfind(".")] + genome
+        genome_index = os.path.abspath(genome_index)
+    return genome, genome_index
+
+
+def _write_chrom_files(tools, bam, chr_order, chr_keep):
+    """
+    Helper function to write the chromosome sizes and names from the header
+    of a BAM file, read once.
+
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str bam: path to BAM file
+    :param str chr_order: path to output chromosome name and size file
+    :param str chr_keep: path to output chromosome name file
+    """
+    header = pm.checkprint(tools.samtools + " view -H " + bam)
+    with open(chr_order, 'w') as order, open(chr_keep, 'w') as keep:
+        for line in header.splitlines():
+            if not line.startswith("@SQ"):
+                continue
+            tags = dict(field.split(":", 1) for field in line.split("\t")[1:]
+                        if ":" in field)
+            order.write("{}\t{}\n".format(tags["SN"], tags["LN"]))
+            keep.write(tags["SN"] + "\n")
+
+
+def _keep_chroms(chr_keep, bed):
+    """
+    Helper function to build a command that keeps the lines of a BED file
+    on the listed chromosomes, by a hash lookup on the first column.
+
+    :param str chr_keep: path to file of chromosome names to keep
+    :param str bed: path to BED file to filter
+    :return str: command writing the filtered BED file to stdout
+    """
+    return ("awk 'NR==FNR {keep[$1]; next} ($1 in keep)' " + chr_keep + " " +
+            bed)
+
+
+def _idxstats(tools, bam):
+    """
+    Helper function to pull per-sequence read counts from the index of a BAM
+    file, without reading the alignments themselves.
+
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str bam: path to indexed BAM file
+    :return dict: sequence name to (mapped, unmapped) read counts; unmapped
+        reads without a position are listed under "*"
+    """
+    counts = {}
+    idxstats = pm.checkprint(tools.samtools + " idxstats " + bam)
+    for line in idxstats.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 4:
+            counts[fields[0]] = (int(fields[2]), int(fields[3]))
+    return counts
+
+
+def _run_concurrently(cmds, target, cores, nofail=False):
+    """
+    Helper function to run independent commands at once, e.g. single
+    threaded bedtools calls over many annotation files. The commands are
+    handed to xargs from a single pm.run call, which fails if any of
+    them fails.
+
+    :param list cmds: shell commands to run
+    :param str | list target: target file(s) of the combined run
+    :param int cores: maximum number of commands to run at once
+    :param bool nofail: if True, continue past failed commands
+    :return int: return code of the combined run
+    """
+    if not cmds:
+        return 0
+    targets = target if isinstance(target, list) else [target]
+    fd, job_file = tempfile.mkstemp(suffix="_jobs.txt",
+                                    dir=os.path.dirname(targets[0]))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("\0".join(cmds))
+        workers = max(1, min(int(cores), len(cmds)))
+        cmd = ("xargs -0 -n 1 -P " + str(workers) + " sh -c < " + job_file)
+        return pm.run(cmd, target, shell=True, nofail=nofail)
+    finally:
+        os.remove(job_file)
+
+
+def _coverage_by_chrom(tools, bed, bam, chr_order, coverage, options="",
+                       nofail=False):
+    """
+    Helper function to run bedtools coverage one chromosome at a time, in
+    parallel, and concatenate the results in chromosome order. The output
+    matches a single whole genome run over the same sorted BED file.
+
+    :param looper.models.AttributeDict tools: binding between tool name and
+        value, e.g. for tools/resources used by the pipeline
+    :param str bed: path to BED file sorted in chr_order
+    :param str bam: path to indexed BAM file
+    :param str chr_order: path to chromosome name and size file
+    :param str coverage: path to output coverage file
+    :param str options: additional bedtools coverage options, e.g. "-counts"
+    :param bool nofail: if True, continue past failed commands
+    """
+    if os.path.exists(coverage):
+        return
+    if not _itsa_file(bed):
+        err_msg = "Unable to calculate coverage; {} is missing or empty."
+        if nofail:
+            pm.warning(err_msg.format(bed))
+            return
+        pm.fail_pipeline(IOError(err_msg.format(bed)))
+    split_dir = tempfile.mkdtemp(dir=os.path.dirname(coverage))
+    try:
+        # Split the BED file by chromosome; it is sorted, so each chromosome
+        # is one contiguous block
+        chrom_beds = {}
+        out = None
+        with open(bed, 'r') as f:
+            for line in f:
+                chrom = line.split("\t", 1)[0]
+                if chrom not in chrom_beds:
+                    if out:
+                        out.close()
+                    chrom_beds[chrom] = os.path.join(
+                        split_dir, str(len(chrom_beds)) + ".bed")
+                    out = open(chrom_beds[chrom], 'w')
+                out.write(line)
+        if out:
+            out.close()
+
+        with open(chr_order, 'r') as f:
+            chroms = [line.split()[0] for line in f if line.strip()]
+        cmds = []
+        targets = []
+        for chrom in chroms:
+            if chrom not in chrom_beds:
+                continue
+            prefix = chrom_beds[chrom][:-len(".bed")]
+            chrom_cov = prefix + "_coverage.bed"
+            # Only the last command of a pipe sets the exit status; a flag
+            # file records a failed samtools view
+            failed = prefix + ".failed"
+            cmd = ("{ " + tools.samtools + " view -u " + bam + " '" + chrom +
+                   "' || touch " + failed + "; } | " + tools.bedtools +
+                   " coverage -sorted " + options + " -a " +
+                   chrom_beds[chrom] + " -b stdin -g " + chr_order + " > " +
+                   chrom_cov + " && [ ! -e " + failed + " ]")
+            cmds.append(cmd)
+            targets.append(chrom_cov)
+        if _run_concurrently(cmds, targets, pm.cores, nofail=nofail):
+            # The shell creates every output, failed or not
+            pm.warning("Unable to calculate coverage over {}; skipping {}"
+                       .format(bed, coverage))
+            return
+
+        # Write to a temporary file first, so an interrupted run does not
+        # leave a truncated file behind to be skipped over next time
+        with open(coverage + ".tmp", 'w') as out:
+            for target in targets:
+                with open(target, 'r') as f:
+                    shutil.copyfileobj(f, out)
+        os.rename(coverage + ".tmp", coverage)
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+
+def _exon_intron_ratios(exons_rpkm, introns_rpkm, ratios):
+    """
+    Helper function to join exon and intron RPKM files on gene name and
+    write the exon to intron RPKM ratio of each gene found in both.
+
+    :param str exons_rpkm: path to BED6 exon RPKM file, one line per gene
+    :param str introns_rpkm: path to BED6 intron RPKM file, one line per gene
+    :param str ratios: path to output BED file of exon coordinates, gene,
+        exon/intron RPKM ratio and strand, sorted by position
+    """
+    with open(introns_rpkm, 'r') as f:
+        intron_rpkm = {}
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 6:
+                intron_rpkm[fields[3]] = float(fields[4])
+    rows = []
+    with open(exons_rpkm, 'r') as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 6 or fields[3] not in intron_rpkm:
+                continue
+            ratio = float(fields[4]) / intron_rpkm[fields[3]]
+            rows.append(fields[:4] + ["{:.6g}".format(ratio), fields[5]])
+    rows.sort(key=lambda row: (row[0], int(row[1]), "\t".join(row)))
+    # Write to a temporary file first, so an interrupted run does not leave
+    # a truncated file behind to be skipped over next time
+    with open(ratios + ".tmp", 'w') as out:
+        for row in rows:
+            out.write("\t".join(row) + "\n")
+    os.rename(ratios + ".tmp", ratios)
+
+
+def _split_features(annotation, outfolder):
+    """
+    Helper function to write the lines of a feature annotation BED file to
+    one file per feature name (column 4), in a single pass.
+
+    :param str annotation: path to feature annotation BED file
+    :param str outfolder: path to folder for the per-feature files
+    """
+    handles = {}
+    try:
+        with open(annotation, 'r') as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 4:
+                    continue
+                feature = fields[3]
+                if feature not in handles:
+                    handles[feature] = open(
+                        os.path.join(outfolder, feature), 'w')
+                handles[feature].write(line)
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def _gene_rpkm(coverage, rpkm_file, scaling_factor):
+    """
+    Helper function to sum the read counts and lengths of the features of
+    each gene in a bedtools coverage -counts file and write the gene RPKM.
+
+    :param str coverage: path to BED6 plus read count coverage file
+    :param str rpkm_file: path to output BED6 file with RPKM in the score
+        column, for genes with an RPKM above zero, sorted by gene name
+    :param float scaling_factor: aligned reads divided by one million
+    """
+    # Gene names such as "NA" or "null" are names, not missing values
+    df = pd.read_csv(coverage, sep="\t", header=None, usecols=range(7),
+                     names=["chrom", "start", "end", "gene", "score",
+                            "strand", "reads"],
+                     dtype={"gene": str}, keep_default_na=False,
+                     na_values=[])
+    # A gene starts where its last contiguous run of features begins
+    run_start = df["gene"].ne(df["gene"].shift())
+    df["run_start"] = df["start"].where(run_start).ffill().astype(int)
+    df["size_kb"] = (df["end"] - df["start"] + 0.00000001).abs() / 1000
+    genes = df.groupby("gene", sort=False).agg(
+        chrom=("chrom", "last"), start=("run_start", "last"),
+        end=("end", "last"), reads=("reads", "sum"),
+        size_kb=("size_kb", "sum"), strand=("strand", "last"))
+    genes["rpkm"] = (genes["reads"] / scaling_factor) / genes["size_kb"]
+    genes = genes[genes["rpkm"] > 0].reset_index().sort_values(
+        "gene", kind="stable")
+    # Write to a temporary file first, so an interrupted run does not leave
+    # a truncated file behind to be skipped over next time
+    genes.to_csv(rpkm_file + ".tmp", sep="\t", header=False, index=False,
+                 columns=["chrom", "start", "end", "gene", "rpkm", "strand"],
+                 float_format="%.6g")
+    os.rename(rpkm_file + ".tmp", rpkm_file)
+
+
+def _parse_bt2_exact1(aln_stats):
+    """
+    Helper function to pull the uniquely aligned read count from a bowtie2
+    alignment summary.
+
+    :param str aln_stats: bowtie2 alignment summary text
+    :return int: number of reads (or concordant pairs, for paired-end
+        alignments) aligned exactly 1 time, or None if absent
+    """
+    for line in aln_stats.splitlines():
+        # the concordant pair count precedes any unpaired mate counts
+        if ('aligned exactly 1 time' in line or
+                'aligned concordantly exactly 1 time' in line):
+            return int(line.split()[0])
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _read_adapters(adapter_file):
+    """
+    Helper function to pull the adapter sequences from an adapter file, where
+    each sequence follows a header containing "5prime" or "3prime".
+
+    :param str adapter_file: path to adapter FASTA file
+    :return (str, str): 5' and 3' adapter sequences, or None if absent
+    """
+    five_prime = three_prime = None
+    with open(adapter_file) as f:
+        lines = f.read().splitlines()
+    for header, seq in zip(lines, lines[1:]):
+        if "5prime" in header and five_prime is None:
+            five_prime = seq.strip()
+        elif "3prime" in header and three_prime is None:
+            three_prime = seq.strip()
+    return five_prime, three_prime
+
+
+def _parse_cutadapt_report(report):
+    """
+    Helper function to pull the number of reads with adapters from a cutadapt
+    report.
+
+    :param str report: path to cutadapt report
+    :return float: number of reads with adapters
+    """
+    with open(report) as f:
+        for line in f:
+            if line.startswith("Reads with adapters:"):
+                return float(line.split()[-2].replace(',', ''))
+    return 0
+
+
+def _parse_fastp_json(report):
+    """
+    Helper function to pull adapter statistics from a fastp JSON report.
+
+    :param str report: path to fastp JSON report
+    :return (float, float): number of reads with adapters and number of reads
+        removed for being too short
+    """
+    with open(report) as f:
+        stats = json.load(f)
+    return (float(stats["adapter_cutting"]["adapter_trimmed_reads"])
+            if "adapter_cutting" in stats else 0,
+            float(stats["filtering_result"]["too_short_reads"]))
+
+
+def _tss_score(tss_file):
+    """
+    Helper function to calculate a TSS enrichment score from a
+    pyTssEnrichment profile.
+
+    The profile is normalized to the mean of its first 5% of positions and
+    the score is the mean normalized signal in the 100 positions around the
+    peak. A lone spike more than 1.5 fold over both neighbours is skipped in
+    favour of the next highest position.
+
+    :param str tss_file: path to TSS enrichment profile, one value per line
+    :return float: TSS enrichment score, or 0 if it can't be calculated
+    """
+    with open(tss_file) as f:
+        floats = np.loadtxt(f, dtype=np.float64, ndmin=1)
+    flank = floats[1:int(0.05*len(floats))]
+    if flank.size == 0 or flank.sum() == 0:
+        return 0
+    normTSS = floats / flank.mean()
+    max_index = int(np.argmax(normTSS))
+
+    try:
+        peak = float(normTSS[max_index])
+        if ((peak/float(normTSS[max_index-1]) > 1.5) and
+                (peak/float(normTSS[max_index+1]) > 1.5)):
+            max_index = int(np.argmax(np.delete(normTSS, max_index))) + 1
+    except ZeroDivisionError:
+        return 0
+
+    window = normTSS[max_index-50:max_index+50]
+    if window.size == 0:
+        return 0
+    return round(float(window.mean()), 1)
+
+
 def _itsa_file(anyfile):
     """
     Helper function to confirm a file exists and is not empty.
@@ -1840,6 +2139,65 @@ def _itsa_empty_file(anyfile):
     return(os.path.isfile(anyfile) and os.stat(anyfile).st_size == 0)
 
 
+def _check_input_file(anyfile):
+    """
+    Fail the pipeline unless an input file exists and is not empty.
+
+    Uses a single stat call per file.
+
+    :param str anyfile: path to a file
+    """
+    try:
+        file_stat = os.stat(anyfile)
+    except OSError:
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        # The file does not exist
+        err_msg = "Could not find: {}"
+        pm.fail_pipeline(IOError(err_msg.format(anyfile)))
+    elif file_stat.st_size == 0:
+        # The file exists but is empty
+        err_msg = "File exists but is empty: {}"
+        pm.fail_pipeline(IOError(err_msg.format(anyfile)))
+    else:
+        print("Local input file: " + anyfile)
+
+
+def _check_fastq(input_files, output_files, paired_end):
+    """
+    Build a follow function that reports raw and converted FASTQ read counts.
+
+    Gzipped FASTQ inputs are decompressed one-to-one into the FASTQ outputs,
+    so their read counts are identical; count the decompressed outputs once
+    rather than gunzipping every input a second time just to count it.
+    Any other input is checked with NGSTk.check_fastq.
+
+    :param str | list input_files: local input files
+    :param str | list output_files: FASTQ files converted from the inputs
+    :param bool paired_end: whether the input is paired-end
+    :return callable: follow function for the conversion command
+    """
+    if not isinstance(input_files, list):
+        input_files = [input_files]
+    if not isinstance(output_files, list):
+        output_files = [output_files]
+    inputs = [f for f in input_files if f]
+    outputs = [f for f in output_files if f]
+    if (len(inputs) != len(outputs) or
+            not all(f.endswith((".fastq.gz", ".fq.gz")) for f in inputs)):
+        return ngstk.check_fastq(input_files, output_files, paired_end)
+
+    def report_reads():
+        total_reads = sum(int(ngstk.count_reads(f, paired_end))
+                          for f in outputs)
+        fastq_reads = int(total_reads / len(outputs))
+        pm.report_result("Raw_reads", str(fastq_reads))
+        pm.report_result("Fastq_reads", fastq_reads)
+        return fastq_reads
+
+    return report_reads
+
+
 def is_gzipped(file_name):
     """
     Determine whether indicated file appears to be gzipped.
@@ -1860,6 +2218,9 @@ def _add_resources(args, res, asset_dict=None):
     :param asset_dict list: list of dictionary of assets to add
     """
 
+    # Imported here rather than at module load; main() resolves resources
+    # without refgenie and does not call this function
+    from refgenconf import RefGenConf as RGC, select_genome_config
     rgc = RGC(select_genome_config(res.get("genome_config")))
 
     key_errors = []
@@ -1936,6 +2297,20 @@ def _add_resources(args, res, asset_dict=None):
         return res, rgc
 
 
+def _remove_at_exit(folder):
+    """
+    Helper function to remove a scratch folder and everything in it when the
+    pipeline exits, whether it completed or failed, unless run with --dirty.
+    pypiper's own cleanup only removes empty folders, and only on success.
+
+    :param str folder: path to folder to remove
+    """
+    def remove():
+        if not pm.dirty:
+            shutil.rmtree(folder, ignore_errors=True)
+    atexit.register(remove)
+
+
 def report_message(pm, report_file, message, annotation=None):
     """
     Writes a string to provided file in a safe way.
@@ -2014,6 +2389,14 @@ def main():
                    f"but provided --input2.")
         pm.fail_pipeline(RuntimeError(err_msg))
 
+    # Scratch space for samtools sort, shared by every alignment.
+    # Prefer PEPPRO_TMP, then the system temporary directory (e.g. local
+    # node scratch on a cluster) over the output folder.
+    sort_tempdir = tempfile.mkdtemp(
+        prefix="peppro_", dir=os.environ.get("PEPPRO_TMP") or None)
+    os.chmod(sort_tempdir, 0o771)
+    _remove_at_exit(sort_tempdir)
+
     ############################################################################
     #                       Set up reference resources                         #
     ############################################################################
@@ -2033,9 +2416,20 @@ def main():
             args.genome_assembly)
         )
     pm.debug(f"primary genome index: {args.genome_index}")
+
+    # Index checks are I/O bound; run them concurrently and cache the results
+    bt2_indices = [res.genome_index]
+    if args.prealignment_index:
+        bt2_indices.extend([_split_prealignment(reference)[1]
+                            for reference in args.prealignment_index])
+    with ThreadPoolExecutor(max_workers=min(8, len(bt2_indices))) as executor:
+        index_found = list(executor.map(_check_bowtie2_index, bt2_indices))
+    for bt2_index, found in zip(bt2_indices, index_found):
+        if not found:
+            pm.warning("Could not find a complete bowtie2 index: {}"
+                       .format(bt2_index))
     
-    if (args.chrom_sizes and os.path.isfile(args.chrom_sizes) and
-            os.stat(args.chrom_sizes).st_size > 0):
+    if args.chrom_sizes and _itsa_file(args.chrom_sizes):
         res.chrom_sizes = os.path.abspath(args.chrom_sizes)
 
     # Add optional files to resources
@@ -2049,33 +2443,21 @@ def main():
                    f"the genome fasta file. Specify this with"
                    f"--fasta <path to fasta file>")
         pm.fail_pipeline(RuntimeError(err_msg))
-    if (args.fasta and os.path.isfile(args.fasta) and
-            os.stat(args.fasta).st_size > 0):
-        res.fasta = os.path.abspath(args.fasta)
-    if (args.search_file and os.path.isfile(args.search_file) and
-            os.stat(args.search_file).st_size > 0):
-        res.search_file = os.path.abspath(args.search_file)
-    if (args.TSS_name and os.path.isfile(args.TSS_name) and
-            os.stat(args.TSS_name).st_size > 0):
-        res.refgene_tss = os.path.abspath(args.TSS_name)
-    if (args.anno_name and os.path.isfile(args.anno_name) and
-            os.stat(args.anno_name).st_size > 0):
-        res.feat_annotation = os.path.abspath(args.anno_name)  
-    if (args.pi_tss and os.path.isfile(args.pi_tss) and
-            os.stat(args.pi_tss).st_size > 0):
-        res.pi_tss = os.path.abspath(args.pi_tss)
-    if (args.pi_body and os.path.isfile(args.pi_body) and
-            os.stat(args.pi_body).st_size > 0):
-        res.pi_body = os.path.abspath(args.pi_body)
-    if (args.pre_name and os.path.isfile(args.pre_name) and
-            os.stat(args.pre_name).st_size > 0):
-        res.pre_name = os.path.abspath(args.pre_name)
-    if (args.exon_name and os.path.isfile(args.exon_name) and
-            os.stat(args.exon_name).st_size > 0):
-        res.exon_name = os.path.abspath(args.exon_name)    
-    if (args.intron_name and os.path.isfile(args.intron_name) and
-            os.stat(args.intron_name).st_size > 0):
-        res.intron_name = os.path.abspath(args.intron_name)    
+    # Resource key and the user-provided path that populates it
+    optional_assets = [
+        ("fasta", args.fasta),
+        ("search_file", args.search_file),
+        ("refgene_tss", args.TSS_name),
+        ("feat_annotation", args.anno_name),
+        ("pi_tss", args.pi_tss),
+        ("pi_body", args.pi_body),
+        ("pre_name", args.pre_name),
+        ("exon_name", args.exon_name),
+        ("intron_name", args.intron_name)
+    ]
+    for asset, asset_path in optional_assets:
+        if asset_path and _itsa_file(asset_path):
+            res[asset] = os.path.abspath(asset_path)
 
     # Adapter file can be set in the config; if left null, we use a default.
     # Expects headers to include >5prime and >3prime
@@ -2109,28 +2491,9 @@ def main():
     ###########################################################################
     #          Check that the input file(s) exist before continuing           #
     ###########################################################################
-    if _itsa_file(args.input[0]):
-        print("Local input file: " + args.input[0])
-    elif _itsa_empty_file(args.input[0]):
-        # The read1 file exists but is empty
-        err_msg = "File exists but is empty: {}"
-        pm.fail_pipeline(IOError(err_msg.format(args.input[0])))
-    else:
-        # The read1 file does not exist
-        err_msg = "Could not find: {}"
-        pm.fail_pipeline(IOError(err_msg.format(args.input[0])))
-
+    _check_input_file(args.input[0])
     if args.input2:
-        if _itsa_file(args.input2[0]):
-            print("Local input file: " + args.input2[0])
-        elif _itsa_empty_file(args.input2[0]):
-            # The read1 file exists but is empty
-            err_msg = "File exists but is empty: {}"
-            pm.fail_pipeline(IOError(err_msg.format(args.input2[0])))
-        else:
-            # The read1 file does not exist
-            err_msg = "Could not find: {}"
-            pm.fail_pipeline(IOError(err_msg.format(args.input2[0])))
+        _check_input_file(args.input2[0])
 
     ###########################################################################
     #                      Grab and prepare input files                       #
@@ -2169,7 +2532,7 @@ def main():
     #       issue here is that process_fastq is still trying to run
     #       if we skip this step
     pm.run(cmd, unaligned_fastq,
-           follow=ngstk.check_fastq(
+           follow=_check_fastq(
                local_input_files, unaligned_fastq, args.paired_end))
     pm.clean_add(out_fastq_pre + "*.fastq", conditional=True)
 
@@ -2178,6 +2541,32 @@ def main():
     untrimmed_fastq1 = out_fastq_pre + "_R1.fastq"
     untrimmed_fastq2 = out_fastq_pre + "_R2.fastq" if args.paired_end else None
 
+    if args.fastq_tmp:
+        # Adapter trimmed and deduplicated reads are at most as large as
+        # their input; keep them on disk if the scratch space can't hold both
+        needed = 2 * sum(os.path.getsize(fq) for fq in
+                         [untrimmed_fastq1, untrimmed_fastq2]
+                         if fq and os.path.exists(fq))
+        # Named after the output folder, so a recovered --dirty run finds
+        # its files
+        scratch_name = "peppro_{}_{:08x}".format(
+            args.sample_name, zlib.crc32(outfolder.encode()))
+        scratch_folder = os.path.join(args.fastq_tmp, scratch_name)
+        try:
+            ngstk.make_dir(scratch_folder)
+            free = shutil.disk_usage(scratch_folder).free
+        except OSError:
+            free = 0
+        if free < needed:
+            pm.warning("Not enough space in {} for intermediate FASTQ files; "
+                       "using {}".format(args.fastq_tmp, fastq_folder))
+            args.fastq_tmp = None
+        else:
+            # The scratch space may be in memory; remove it however the run
+            # ends
+            args.fastq_tmp = scratch_folder
+            _remove_at_exit(scratch_folder)
+
     ############################################################################
     #                          Process read files                              #
     ############################################################################
@@ -2207,7 +2596,7 @@ def main():
                        "for single end data.".format(args.adapter))
 
     if args.paired_end:
-        if not args.complexity and int(args.umi_len) > 0:
+        if not args.complexity and args.umi_len > 0:
             if not os.path.exists(processed_target_R1) or args.new_start:
                 unmap_fq1, unmap_fq1_dups = _process_fastq(
                     args, tools, res, False,
@@ -2260,7 +2649,7 @@ def main():
         if (rr < 1):
             pm.fail_pipeline(RuntimeError("Raw_reads were not reported. Check output ({})".format(param.outfolder)))
 
-        if args.adapter == "fastp" and int(args.umi_len) > 0:
+        if args.adapter == "fastp" and args.umi_len > 0:
             noUMI_fq1 = os.path.join(fastq_folder,
                 args.sample_name + "_R1_processed_noUMI.fastq")
             noUMI_fq2 = os.path.join(fastq_folder,
@@ -2286,7 +2675,7 @@ def main():
         pm.clean_add(r2_repair_single)
 
         # Re-pair the duplicates (but only if we could identify duplicates)
-        if int(args.umi_len) > 0:
+        if args.umi_len > 0:
             r1_dups_repair = os.path.join(
                 fastq_folder, args.sample_name + "_R1_trimmed.fastq.paired.fq")
             r2_dups_repair = os.path.join(
@@ -2297,7 +2686,7 @@ def main():
             r2_dups_repair_single = os.path.join(
                 fastq_folder, args.sample_name + "_R2_trimmed_dups.fastq.single.fq")
 
-            if args.adapter == "fastp" and int(args.umi_len) > 0:
+            if args.adapter == "fastp" and args.umi_len > 0:
                 noUMI_fq1_dups = os.path.join(fastq_folder,
                     args.sample_name + "_R1_trimmed_dups_noUMI.fastq")
                 noUMI_fq2_dups = os.path.join(fastq_folder,
@@ -2321,7 +2710,7 @@ def main():
             pm.clean_add(r1_dups_repair_single)
             pm.clean_add(r2_dups_repair_single)
     else:
-        if not args.complexity and int(args.umi_len) > 0:
+        if not args.complexity and args.umi_len > 0:
             if not os.path.exists(processed_target_R1) or args.new_start:
                 unmap_fq1, unmap_fq1_dups = _process_fastq(
                     args, tools, res, False,
@@ -2357,7 +2746,7 @@ def main():
                 args.sample_name + "_R1_adapter_insertion_distribution.png")
             cmd = (tools.Rscript + " " + tool_path("PEPPRO.R") + 
                    " cutadapt -i " + cutadapt_report + " -o " + cutadapt_folder)
-            if int(args.umi_len) > 0:
+            if args.umi_len > 0:
                 cmd += (" -u " + str(args.umi_len))
                 umi_len = args.umi_len
             else:
@@ -2467,80 +2856,38 @@ def main():
 
     else:
         # Loop through any prealignment references and map to them sequentially
+        use_fifo = not args.no_fifo
+        align_dups = not args.complexity and args.umi_len > 0
         for reference in res.prealignment_index:
             pm.debug(f"prealignment reference: {reference}")
             #res.genome_index = rgc.seek(reference, BT2_IDX_KEY) # DEPRECATED
-            genome, genome_index = reference.split('=')
-            if genome_index.endswith("."):
-                # Replace last occurrence of . with genome name
-                genome_index = genome_index[:genome_index.rfind(".")] + genome
-                genome_index = os.path.abspath(genome_index)
-            if not args.complexity and int(args.umi_len) > 0:
-                if args.no_fifo:
-                    unmap_fq1, unmap_fq2 = _align_with_bt2(
-                        args, tools, args.paired_end, False, unmap_fq1,
-                        unmap_fq2, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        bt2_opts_txt=param.bowtie2_pre.params)
-
-                    unmap_fq1_dups, unmap_fq2_dups = _align_with_bt2(
-                        args, tools, args.paired_end, False, unmap_fq1_dups,
-                        unmap_fq2_dups, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        dups=True,
-                        bt2_opts_txt=param.bowtie2_pre.params)
-                else:
-                    unmap_fq1, unmap_fq2 = _align_with_bt2(
-                        args, tools, args.paired_end, True, unmap_fq1,
-                        unmap_fq2, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        bt2_opts_txt=param.bowtie2_pre.params)
-
-                    unmap_fq1_dups, unmap_fq2_dups = _align_with_bt2(
-                        args, tools, args.paired_end, True, unmap_fq1_dups,
-                        unmap_fq2_dups, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        dups=True,
-                        bt2_opts_txt=param.bowtie2_pre.params)
-
+            genome, genome_index = _split_prealignment(reference)
+            unmap_fq1, unmap_fq2 = _align_with_bt2(
+                args, tools, args.paired_end, use_fifo, unmap_fq1,
+                unmap_fq2, genome,
+                assembly_bt2=genome_index,
+                outfolder=param.outfolder,
+                aligndir="prealignments",
+                bt2_opts_txt=param.bowtie2_pre.params,
+                sort_tempdir=sort_tempdir)
+
+            if align_dups:
+                unmap_fq1_dups, unmap_fq2_dups = _align_with_bt2(
+                    args, tools, args.paired_end, use_fifo, unmap_fq1_dups,
+                    unmap_fq2_dups, genome,
+                    assembly_bt2=genome_index,
+                    outfolder=param.outfolder,
+                    aligndir="prealignments",
+                    dups=True,
+                    bt2_opts_txt=param.bowtie2_pre.params,
+                    sort_tempdir=sort_tempdir)
+                to_compress.append(unmap_fq1_dups)
                 if args.paired_end:
-                    to_compress.append(unmap_fq1_dups)
                     to_compress.append(unmap_fq2_dups)
-                    to_compress.append(unmap_fq1)
-                    to_compress.append(unmap_fq2)
-                else:
-                    to_compress.append(unmap_fq1_dups)
-                    to_compress.append(unmap_fq1)
-            else:
-                if args.no_fifo:
-                    unmap_fq1, unmap_fq2 = _align_with_bt2(
-                        args, tools, args.paired_end, False,
-                        unmap_fq1, unmap_fq2, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        bt2_opts_txt=param.bowtie2_pre.params)
-                else:
-                    unmap_fq1, unmap_fq2 = _align_with_bt2(
-                        args, tools, args.paired_end, True,
-                        unmap_fq1, unmap_fq2, genome,
-                        assembly_bt2=genome_index,
-                        outfolder=param.outfolder,
-                        aligndir="prealignments",
-                        bt2_opts_txt=param.bowtie2_pre.params)
-                if args.paired_end:
-                    to_compress.append(unmap_fq1)
-                    to_compress.append(unmap_fq2)
-                else:
-                    to_compress.append(unmap_fq1)
+
+            to_compress.append(unmap_fq1)
+            if args.paired_end:
+                to_compress.append(unmap_fq2)
 
     ############################################################################
     #                           Map to primary genome                          #
@@ -2593,39 +2940,44 @@ def main():
         bt2_options = param.bowtie2.params
 
     # samtools sort needs a temporary directory
-    tempdir = tempfile.mkdtemp(dir=map_genome_folder)
-    os.chmod(tempdir, 0o771)
-    pm.clean_add(tempdir)
+    tempdir = tempfile.mkdtemp(dir=sort_tempdir)
 
     # check input for zipped or not
     unmap_fq1_gz = unmap_fq1 + ".gz"
     unmap_fq2_gz = unmap_fq2 + ".gz"
 
     # res.genome_index = rgc.seek(args.genome_assembly, BT2_IDX_KEY)  # DEPRECATED
+    # bowtie2 reads gzipped FASTQ directly; align already compressed reads
+    # as they are rather than decompressing them to disk and back again
+    genome_fq1 = unmap_fq1
     if _itsa_file(unmap_fq1_gz) and not _itsa_file(unmap_fq1):
-        cmd = (ngstk.ziptool + " -d " + unmap_fq1_gz)
-        pm.run(cmd, mapping_genome_bam)
-        to_compress.append(unmap_fq1)
+        genome_fq1 = unmap_fq1_gz
     if args.paired_end:
+        genome_fq2 = unmap_fq2
         if _itsa_file(unmap_fq2_gz) and not _itsa_file(unmap_fq2):
-            cmd = (ngstk.ziptool + " -d " + unmap_fq2_gz)
-            pm.run(cmd, mapping_genome_bam)
-        to_compress.append(unmap_fq2)
+            genome_fq2 = unmap_fq2_gz
+        else:
+            to_compress.append(unmap_fq2)
 
+    # samtools sort reads SAM directly and writes the index as it goes,
+    # so the separate view to BAM and later index passes are unnecessary.
+    # The temporary BAM is only re-read by the MAPQ filter below, so write
+    # it at compression level 1
+    sort_threads = max(1, int(pm.cores) // 2)
     cmd = tools.bowtie2 + " -p " + str(pm.cores)
     cmd += bt2_options
     cmd += " --rg-id " + args.sample_name
     cmd += " -x " + res.genome_index
     if args.paired_end:
-        cmd += " --rf -1 " + unmap_fq1 + " -2 " + unmap_fq2
+        cmd += " --rf -1 " + genome_fq1 + " -2 " + genome_fq2
     else:
-        cmd += " -U " + unmap_fq1
-    cmd += " | " + tools.samtools + " view -bS - -@ 1 "
-    cmd += " | " + tools.samtools + " sort - -@ 1"
+        cmd += " -U " + genome_fq1
+    cmd += " | " + tools.samtools + " sort - -@ " + str(sort_threads)
+    cmd += " -m 1G -l 1 --write-index"
     cmd += " -T " + tempdir
-    cmd += " -o " + mapping_genome_bam_temp
+    cmd += " -o " + mapping_genome_bam_temp + "##idx##" + temp_mapping_index
 
-    if not args.complexity and int(args.umi_len) > 0:
+    if not args.complexity and args.umi_len > 0:
         # check input for zipped or not
         if pypiper.is_gzipped_fastq(unmap_fq1_dups):
             cmd = (ngstk.ziptool + " -d " + (unmap_fq1_dups + ".gz"))
@@ -2643,28 +2995,43 @@ def main():
             cmd_dups += " --rf -1 " + unmap_fq1_dups + " -2 " + unmap_fq2_dups
         else:
             cmd_dups += " -U " + unmap_fq1_dups
-        cmd_dups += " | " + tools.samtools + " view -bS - -@ 1 "
-        cmd_dups += " | " + tools.samtools + " sort - -@ 1"
+        cmd_dups += " | " + tools.samtools + " sort - -@ " + str(sort_threads)
+        cmd_dups += " -m 1G -l 1 --write-index"
         cmd_dups += " -T " + tempdir
-        cmd_dups += " -o " + mapping_genome_bam_temp_dups
+        cmd_dups += (" -o " + mapping_genome_bam_temp_dups + "##idx##" +
+                     temp_mapping_index_dups)
 
     # Split genome mapping result bamfile into two: high-quality aligned
     # reads (keepers) and unmapped reads (in case we want to analyze the
     # altogether unmapped reads)
     # -q 10: skip alignments with MAPQ less than 10
+    # The filtered bam files are indexed as they are written, ready for
+    # idxstats and region queries
+    mapping_genome_index = os.path.join(mapping_genome_bam + ".bai")
     cmd2 = (tools.samtools + " view -q 10 -b -@ " + str(pm.cores) +
-            " -U " + failQC_genome_bam + " ")
-    cmd2 += mapping_genome_bam_temp + " > " + mapping_genome_bam
+            " -U " + failQC_genome_bam + " --write-index ")
+    cmd2 += (mapping_genome_bam_temp + " -o " + mapping_genome_bam +
+             "##idx##" + mapping_genome_index)
 
-    if not args.complexity and int(args.umi_len) > 0:
+    if not args.complexity and args.umi_len > 0:
+        mapping_genome_index_dups = os.path.join(
+            mapping_genome_bam_dups + ".bai")
         cmd2_dups = (tools.samtools + " view -q 10 -b -@ " + str(pm.cores) +
-                     " -U " + failQC_genome_bam_dups + " ")
-        cmd2_dups += mapping_genome_bam_temp_dups + " > " + mapping_genome_bam_dups
+                     " -U " + failQC_genome_bam_dups + " --write-index ")
+        cmd2_dups += (mapping_genome_bam_temp_dups + " -o " +
+                      mapping_genome_bam_dups + "##idx##" +
+                      mapping_genome_index_dups)
         pm.clean_add(failQC_genome_bam_dups)
 
     def check_alignment_genome(temp_bam, bam):
-        mr = ngstk.count_mapped_reads(temp_bam, args.paired_end)
-        ar = ngstk.count_mapped_reads(bam, args.paired_end)
+        # Both bam files are indexed as they are written, so take the
+        # mapped counts from the indexes rather than rereading the files
+        if os.path.exists(temp_bam + ".bai") and os.path.exists(bam + ".bai"):
+            mr = sum(m for m, _ in _idxstats(tools, temp_bam).values())
+            ar = sum(m for m, _ in _idxstats(tools, bam).values())
+        else:
+            mr = ngstk.count_mapped_reads(temp_bam, args.paired_end)
+            ar = ngstk.count_mapped_reads(bam, args.paired_end)
 
         if float(ar) < 1:
             err_msg = "No aligned reads. Check alignment settings."
@@ -2690,8 +3057,12 @@ def main():
                    " | awk '{counter++;sum+=$3}END{print sum/counter}'")
             rd = pm.checkprint(cmd)
         else:
-            cmd = (tools.samtools + " depth " + bam +
-                   " | awk '{counter++;sum+=$3}END{print sum/counter}'")
+            # Mean depth over covered bases from the per-contig summary
+            # (meandepth * contig length / covbases) rather than a
+            # per-base depth listing
+            cmd = (tools.samtools + " coverage " + bam +
+                   " | awk 'NR>1 {sum+=$7*($3-$2+1); counter+=$5}" +
+                   "END{if (counter) print sum/counter}'")
             rd = pm.checkprint(cmd)
 
         pm.report_result("Mapped_reads", mr)
@@ -2709,7 +3080,7 @@ def main():
            follow=lambda: check_alignment_genome(mapping_genome_bam_temp,
                                                  mapping_genome_bam))
 
-    if not args.complexity and int(args.umi_len) > 0:
+    if not args.complexity and args.umi_len > 0:
         if not _itsa_file(preseq_pdf) or args.new_start:
             pm.run([cmd_dups, cmd2_dups], mapping_genome_bam_dups)
 
@@ -2725,14 +3096,10 @@ def main():
                 pm.run(cmd, unmapped_fq)
 
     if not args.prealignment_names and os.path.exists(mapping_genome_bam_temp):
-        # Index the temporary bam file
-        cmd = tools.samtools + " index " + mapping_genome_bam_temp
-        pm.run(cmd, temp_mapping_index)
+        # The temporary bam files were indexed while sorting
         pm.clean_add(temp_mapping_index)
 
-        if not args.complexity and int(args.umi_len) > 0:
-            cmd_dups = tools.samtools + " index " + mapping_genome_bam_temp_dups
-            pm.run(cmd_dups, temp_mapping_index_dups)
+        if not args.complexity and args.umi_len > 0:
             pm.clean_add(temp_mapping_index_dups)
             pm.clean_add(mapping_genome_bam_temp_dups)
 
@@ -2744,22 +3111,17 @@ def main():
                 pm.run(cmd, temp_mapping_index)
                 pm.clean_add(temp_mapping_index)
 
-            cmd = (tools.samtools + " idxstats " +
-                   mapping_genome_bam_temp + " | grep")
-            for name in mito_name:
-                cmd += " -we '" + name + "'"
-            cmd += "| cut -f 3"
-            mr = pm.checkprint(cmd)
+            temp_counts = _idxstats(tools, mapping_genome_bam_temp)
+            mito_counts = [temp_counts[name][0] for name in mito_name
+                           if name in temp_counts]
             # If there are mitochondrial reads, by default remove them
-            if mr and mr.strip():
-                pm.report_result("Mitochondrial_reads", round(float(mr)))
-                # Index the sort'ed BAM file first
-                mapping_genome_index = os.path.join(mapping_genome_bam + ".bai")
+            if mito_counts:
+                pm.report_result("Mitochondrial_reads", sum(mito_counts))
+                # The filtered BAM file was indexed when it was written
                 noMT_mapping_genome_bam = os.path.join(
                     map_genome_folder, args.sample_name + "_noMT.bam")
                 chr_bed = os.path.join(map_genome_folder, "chr_sizes.bed")
 
-                cmd1 = tools.samtools + " index " + mapping_genome_bam
                 cmd2 = (tools.samtools + " idxstats " + mapping_genome_bam +
                         " | cut -f 1-2 | awk '{print $1, 0, $2}' ")
                 # If keeping mt reads, skip this step
@@ -2768,13 +3130,16 @@ def main():
                     for name in mito_name:
                         cmd2 += " -vwe '" + name + "'"
                 cmd2 += (" > " + chr_bed)
+                noMT_mapping_genome_index = noMT_mapping_genome_bam + ".bai"
                 cmd3 = (tools.samtools + " view -L " + chr_bed + " -b -@ " +
-                        str(pm.cores) + " " + mapping_genome_bam + " > " +
-                        noMT_mapping_genome_bam)
+                        str(pm.cores) + " --write-index " +
+                        mapping_genome_bam + " -o " + noMT_mapping_genome_bam +
+                        "##idx##" + noMT_mapping_genome_index)
                 cmd4 = ("mv " + noMT_mapping_genome_bam +
                         " " + mapping_genome_bam)
-                cmd5 = tools.samtools + " index " + mapping_genome_bam
-                pm.run([cmd1, cmd2, cmd3, cmd4, cmd5], noMT_mapping_genome_bam)
+                cmd5 = ("mv " + noMT_mapping_genome_index +
+                        " " + mapping_genome_index)
+                pm.run([cmd2, cmd3, cmd4, cmd5], noMT_mapping_genome_bam)
                 pm.clean_add(mapping_genome_index)
                 pm.clean_add(chr_bed)
 
@@ -2785,13 +3150,12 @@ def main():
             map_genome_folder, args.sample_name + "_PE1.bam")
         mapping_pe2_bam = os.path.join(
             map_genome_folder, args.sample_name + "_PE2.bam")
-        cmd1 = (tools.samtools + " view -b -f 64 " + mapping_genome_bam +
-                " | " + tools.samtools + " sort - -@ " + str(pm.cores) +
-                " > " + mapping_pe1_bam)
-        cmd2 = (tools.samtools + " view -b -f 128 " + mapping_genome_bam +
-                " | " + tools.samtools + " sort - -@ " + str(pm.cores) +
-                " > " + mapping_pe2_bam)
-        pm.run([cmd1, cmd2], [mapping_pe1_bam, mapping_pe2_bam])
+        # Filtering keeps the coordinate order, so no re-sort is needed;
+        # read1s pass the filter and the read2s are written with -U
+        cmd = (tools.samtools + " view -b -@ " + str(pm.cores) + " -f 64" +
+               " -U " + mapping_pe2_bam + " -o " + mapping_pe1_bam + " " +
+               mapping_genome_bam)
+        pm.run(cmd, [mapping_pe1_bam, mapping_pe2_bam])
         mapping_genome_bam = mapping_pe1_bam
 
     ############################################################################
@@ -2799,11 +3163,14 @@ def main():
     ############################################################################
 
     if not pm.get_stat("Maximum_read_length") or args.new_start:
-        if int(args.max_len) > 0:
-            max_len = int(args.max_len)
+        if args.max_len > 0:
+            max_len = args.max_len
         elif _itsa_file(mapping_genome_bam):
-            cmd = (tools.samtools + " stats " + mapping_genome_bam +
-                   " | grep '^SN' | cut -f 2- | grep 'maximum length:' | cut -f 2-")
+            # Only the longest sequence is needed, not the full set of
+            # samtools stats metrics
+            cmd = (tools.samtools + " view -@ " + str(pm.cores) + " " +
+                   mapping_genome_bam + " | awk '{if (length($10) > m) " +
+                   "m = length($10)} END {print m + 0}'")
             max_len = int(pm.checkprint(cmd))
         else:
             max_len = int(DEFAULT_MAX_LEN)
@@ -2819,9 +3186,9 @@ def main():
 
     # Calculate size of genome
     if not pm.get_stat("Genome_size") or args.new_start:
-        genome_size = int(pm.checkprint(
-            ("awk '{sum+=$2} END {printf \"%.0f\", sum}' " +
-             res.chrom_sizes)))
+        with open(res.chrom_sizes, 'r') as f:
+            genome_size = sum(int(line.split()[1]) for line in f
+                              if line.strip())
         pm.report_result("Genome_size", genome_size)
     else:
         genome_size = int(pm.get_stat("Genome_size"))
@@ -2841,41 +3208,40 @@ def main():
         QC_folder, args.sample_name + "_preseq_plot.png")
 
     if not _itsa_file(preseq_pdf) or args.new_start:
-        if not args.complexity and int(args.umi_len) > 0:
+        if not args.complexity and args.umi_len > 0:
             if os.path.exists(mapping_genome_bam_temp_dups):
                 if not os.path.exists(temp_mapping_index_dups):
                     cmd = tools.samtools + " index " + mapping_genome_bam_temp_dups
                     pm.run(cmd, temp_mapping_index_dups)
                     pm.clean_add(temp_mapping_index_dups)
 
-                cmd_dups = (tools.samtools + " idxstats " +
-                            mapping_genome_bam_temp_dups + " | grep")
-                for name in mito_name:
-                    cmd_dups += " -we '" + name + "'"
-                cmd_dups += "| cut -f 3"
-                mr_dups = pm.checkprint(cmd_dups)
-
-                if mr_dups and mr_dups.strip():
-                    # Index the sort'ed BAM file first
+                temp_counts_dups = _idxstats(tools,
+                                             mapping_genome_bam_temp_dups)
+                if any(name in temp_counts_dups for name in mito_name):
+                    # The filtered BAM file was indexed when it was written
                     mapping_genome_index_dups = os.path.join(
                         mapping_genome_bam_dups + ".bai")
                     noMT_mapping_genome_bam_dups = os.path.join(
                         map_genome_folder, args.sample_name + "_noMT_dups.bam")
 
-                    cmd1 = tools.samtools + " index " + mapping_genome_bam_dups
                     cmd2 = (tools.samtools + " idxstats " +
                             mapping_genome_bam_dups + " | cut -f 1 ")
                     if not args.keep_mito:
                         cmd2 += " | grep "
                         for name in mito_name:
                             cmd2 += " -vwe '" + name + "'"
+                    noMT_mapping_genome_index_dups = (
+                        noMT_mapping_genome_bam_dups + ".bai")
                     cmd2 += (" | xargs " + tools.samtools + " view -b -@ " +
-                             str(pm.cores) + " " + mapping_genome_bam_dups +
-                             " > " + noMT_mapping_genome_bam_dups)
+                             str(pm.cores) + " --write-index -o " +
+                             noMT_mapping_genome_bam_dups + "##idx##" +
+                             noMT_mapping_genome_index_dups + " " +
+                             mapping_genome_bam_dups)
                     cmd3 = ("mv " + noMT_mapping_genome_bam_dups + " " +
                             mapping_genome_bam_dups)
-                    cmd4 = tools.samtools + " index " + mapping_genome_bam_dups
-                    pm.run([cmd1, cmd2, cmd3, cmd4], mapping_genome_bam_dups)
+                    cmd4 = ("mv " + noMT_mapping_genome_index_dups + " " +
+                            mapping_genome_index_dups)
+                    pm.run([cmd2, cmd3, cmd4], mapping_genome_bam_dups)
                     pm.clean_add(mapping_genome_index_dups)
 
             # Remove PE2 reads
@@ -2884,24 +3250,24 @@ def main():
                     map_genome_folder, args.sample_name + "_dups_PE1.bam")
                 dups_pe2_bam = os.path.join(
                     map_genome_folder, args.sample_name + "_dups_PE2.bam")
-                cmd1 = (tools.samtools + " view -b -f 64 " +
-                    mapping_genome_bam_dups + " | " + tools.samtools +
-                    " sort - -@ " + str(pm.cores) + " > " + dups_pe1_bam)
-                cmd2 = (tools.samtools + " view -b -f 128 " +
-                    mapping_genome_bam_dups + " | " + tools.samtools +
-                    " sort - -@ " + str(pm.cores) + " > " + dups_pe2_bam)
-                pm.run([cmd1, cmd2], [dups_pe1_bam, dups_pe2_bam])
+                cmd = (tools.samtools + " view -b -@ " + str(pm.cores) +
+                       " -f 64 -U " + dups_pe2_bam + " -o " + dups_pe1_bam +
+                       " " + mapping_genome_bam_dups)
+                pm.run(cmd, [dups_pe1_bam, dups_pe2_bam])
                 mapping_genome_bam_dups = dups_pe1_bam
 
             pm.timestamp("### Calculate library complexity")
 
+            # c_curve and lc_extrap each read the whole BAM independently;
+            # run them side by side. Only a c_curve failure is fatal: the
+            # exit status is c_curve's, and a missing lc_extrap yield is
+            # handled below
             cmd1 = (tools.preseq + " c_curve -v -o " + preseq_output +
                     " -B " + mapping_genome_bam_dups)
-            pm.run(cmd1, preseq_output)
-
             cmd2 = (tools.preseq + " lc_extrap -v -o " + preseq_yield +
                     " -B " + mapping_genome_bam_dups)
-            pm.run(cmd2, preseq_yield, nofail=True)
+            pm.run(cmd1 + " & " + cmd2 + "; wait $!",
+                   [preseq_output, preseq_yield], shell=True)
 
             if os.path.exists(preseq_yield):
                 # cmd3 = ("bam2mr " + mapping_genome_bam_dups +
@@ -2909,10 +3275,11 @@ def main():
                 # cmd4 = (tools.preseq + " gc_extrap -v -o " + preseq_cov +
                 #         " " + preseq_mr)
                 cmd5 = ("echo '" + preseq_yield +
-                        " '$(" + tools.samtools + " view -c -F 4 " + 
-                        mapping_genome_bam_dups + ")" + "' '" +
-                        "$(" + tools.samtools + " view -c -F 4 " +
-                        mapping_genome_bam + ") > " + preseq_counts)
+                        " '$(" + tools.samtools + " view -c -F 4 -@ " +
+                        str(pm.cores) + " " + mapping_genome_bam_dups + ")" +
+                        "' '" + "$(" + tools.samtools + " view -c -F 4 -@ " +
+                        str(pm.cores) + " " + mapping_genome_bam + ") > " +
+                        preseq_counts)
 
                 # pm.run([cmd3, cmd4, cmd5],
                 #        [preseq_mr, preseq_cov, preseq_counts])
@@ -2924,7 +3291,7 @@ def main():
                 cmd = (tools.Rscript + " " + tool_path("PEPPRO.R") +
                        " preseq " + "-i " + preseq_yield)
                 if args.coverage:
-                    cmd += (" -c " + str(genome_size) + " -l " + max_len)
+                    cmd += (" -c " + str(genome_size) + " -l " + str(max_len))
                 cmd += (" -r " + preseq_counts + " -o " + preseq_plot)
 
                 pm.run(cmd, [preseq_pdf, preseq_png])
@@ -2951,7 +3318,8 @@ def main():
 
     # Need index for mapping_genome_bam before calculating bamQC metrics
     mapping_genome_index = os.path.join(mapping_genome_bam + ".bai")
-    cmd = tools.samtools + " index " + mapping_genome_bam
+    cmd = (tools.samtools + " index -@ " + str(pm.cores) + " " +
+           mapping_genome_bam)
     pm.run(cmd, mapping_genome_index)
 
     bamQC = os.path.join(QC_folder, args.sample_name + "_bamQC.tsv")
@@ -2964,18 +3332,12 @@ def main():
     def report_bam_qc(bamqc_log):
         # Reported BAM QC metrics via the bamQC metrics file
         if os.path.isfile(bamqc_log):
-            cmd1 = ("awk '{ for (i=1; i<=NF; ++i) {" +
-                    " if ($i ~ \"NRF\") c=i } getline; print $c }' " +
-                    bamqc_log)
-            cmd2 = ("awk '{ for (i=1; i<=NF; ++i) {" +
-                    " if ($i ~ \"PBC1\") c=i } getline; print $c }' " +
-                    bamqc_log)
-            cmd3 = ("awk '{ for (i=1; i<=NF; ++i) {" +
-                    " if ($i ~ \"PBC2\") c=i } getline; print $c }' " +
-                    bamqc_log)
-            nrf = pm.checkprint(cmd1)
-            pbc1 = pm.checkprint(cmd2)
-            pbc2 = pm.checkprint(cmd3)
+            # A header line followed by a single row of values
+            with open(bamqc_log) as f:
+                bamqc = dict(zip(f.readline().split(), f.readline().split()))
+            nrf = bamqc["NRF"]
+            pbc1 = bamqc["PBC1"]
+            pbc2 = bamqc["PBC2"]
         else:
             # there were no successful chromosomes yielding results
             nrf = 0
@@ -2992,10 +3354,14 @@ def main():
     #                     Produce unmapped reads file                          #
     ############################################################################
     def count_unmapped_reads():
-        # Report total number of unmapped reads (-f 4)
-        cmd = (tools.samtools + " view -c -f 4 -@ " + str(pm.cores) +
-               " " + mapping_genome_bam_temp)
-        ur = pm.checkprint(cmd)
+        # Report total number of unmapped reads (-f 4), from the index
+        if os.path.exists(temp_mapping_index):
+            ur = sum(u for _, u in
+                     _idxstats(tools, mapping_genome_bam_temp).values())
+        else:
+            cmd = (tools.samtools + " view -c -f 4 -@ " + str(pm.cores) +
+                   " " + mapping_genome_bam_temp)
+            ur = pm.checkprint(cmd)
         pm.report_result("Unmapped_reads", round(float(ur)))
 
     unmap_cmd = tools.samtools + " view -b -@ " + str(pm.cores)
@@ -3006,7 +3372,12 @@ def main():
         # require only read unmapped
         unmap_cmd += " -f 4 "
 
-    unmap_cmd += " " + mapping_genome_bam_temp + " > " + unmap_genome_bam
+    unmap_cmd += " " + mapping_genome_bam_temp
+    if os.path.exists(temp_mapping_index):
+        # Fully unmapped reads (and pairs) have no position and are sorted
+        # to the end; with the index, read only that region
+        unmap_cmd += " '*'"
+    unmap_cmd += " > " + unmap_genome_bam
     pm.run(unmap_cmd, unmap_genome_bam, follow=count_unmapped_reads)
 
     # Remove temporary bam file from unmapped file production
@@ -3021,25 +3392,31 @@ def main():
     minus_bam = os.path.join(
         map_genome_folder, args.sample_name + "_minus.bam")
     
-    cmd1 = build_command([
-        tools.samtools,
-        "view",
-        "-bh",
-        ("-F", 20),
-        mapping_genome_bam,
-        (">", plus_bam)
-    ])
-
-    cmd2 = build_command([
+    # Split in a single pass: reverse strand reads pass the filter and the
+    # rest are written with -U. The MAPQ filtered BAM holds no unmapped
+    # reads, so the remainder is exactly the plus strand (-F 20)
+    # Only the main output can be indexed as it is written
+    cmd = build_command([
         tools.samtools,
         "view",
         "-bh",
+        ("-@", pm.cores),
         ("-f", 16),
-        mapping_genome_bam,
-        (">", minus_bam)
+        ("-U", plus_bam),
+        "--write-index",
+        ("-o", minus_bam + "##idx##" + minus_bam + ".bai"),
+        mapping_genome_bam
     ])
-    
-    pm.run([cmd1, cmd2], [plus_bam, minus_bam])
+
+    pm.run(cmd, [plus_bam, minus_bam])
+
+    # Index the plus strand up front; the FRiF read count and the signal
+    # tracks read both strands through the index. The minus strand index is
+    # skipped unless resuming from a split that did not write it
+    for strand_bam in [plus_bam, minus_bam]:
+        cmd = (tools.samtools + " index -@ " + str(pm.cores) + " " +
+               strand_bam)
+        pm.run(cmd, strand_bam + ".bai")
 
     ############################################################################
     #                             TSS enrichment                               #
@@ -3073,71 +3450,33 @@ def main():
                 ])
                 pm.run(cmd, mapping_genome_index)
 
-            # Plus TSS enrichment
-            cmd = tool_path("pyTssEnrichment.py")
-            cmd += " -a " + mapping_genome_bam + " -b " + plus_TSS + " -p ends"
-            cmd += " -c " + str(pm.cores)
-            cmd += " -z -v -s 6 -o " + Tss_plus
-            pm.run(cmd, Tss_plus, nofail=True)
+            # Plus and minus TSS enrichment are independent; run them side
+            # by side, each with half of the cores
+            tss_cores = str(max(1, int(pm.cores) // 2))
+            cmd1 = tool_path("pyTssEnrichment.py")
+            cmd1 += " -a " + mapping_genome_bam + " -b " + plus_TSS
+            cmd1 += " -p ends -c " + tss_cores
+            cmd1 += " -z -v -s 6 -o " + Tss_plus
+            cmd2 = tool_path("pyTssEnrichment.py")
+            cmd2 += " -a " + mapping_genome_bam + " -b " + minus_TSS
+            cmd2 += " -p ends -c " + tss_cores
+            cmd2 += " -z -v -s 6 -o " + Tss_minus
+            # Wait on both profiles and fail if either one fails
+            tss_failed = pm.run(cmd1 + " & p=$!; " + cmd2 + "; r=$?; " +
+                                "wait $p && [ $r -eq 0 ]",
+                                [Tss_plus, Tss_minus], shell=True,
+                                nofail=True)
             pm.clean_add(plus_TSS)
             pm.clean_add(Tss_plus)
-
-            with open(Tss_plus) as f:
-                floats = list(map(float, f))
-            try:
-                # Catch if the TSS score is trying to divide by 0           
-                list_len = 0.05*float(len(floats))
-                normTSS = [x / (sum(floats[1:int(list_len)]) /
-                           len(floats[1:int(list_len)])) for x in floats]
-                max_index = normTSS.index(max(normTSS))
-
-                if (((normTSS[max_index]/normTSS[max_index-1]) > 1.5) and
-                    ((normTSS[max_index]/normTSS[max_index+1]) > 1.5)):
-                    tmpTSS = list(normTSS)
-                    del tmpTSS[max_index]
-                    max_index = tmpTSS.index(max(tmpTSS)) + 1
-
-                Tss_score = round(
-                    (sum(normTSS[int(max_index-50):int(max_index+50)])) /
-                    (len(normTSS[int(max_index-50):int(max_index+50)])), 1)
-
-                pm.report_result("TSS_coding_score", round(Tss_score, 1))
-            except ZeroDivisionError:
-                pm.report_result("TSS_coding_score", 0)
-                pass
-
-            # Minus TSS enrichment
-            cmd = tool_path("pyTssEnrichment.py")
-            cmd += " -a " + mapping_genome_bam + " -b " + minus_TSS + " -p ends"
-            cmd += " -c " + str(pm.cores)
-            cmd += " -z -v -s 6 -o " + Tss_minus
-            pm.run(cmd, Tss_minus, nofail=True)
             pm.clean_add(minus_TSS)
             pm.clean_add(Tss_minus)
 
-            with open(Tss_minus) as f:
-                floats = list(map(float, f))
-            try:
-                # If the TSS enrichment is 0, don't report
-                list_len = 0.05*float(len(floats))
-                normTSS = [x / (sum(floats[1:int(list_len)]) /
-                           len(floats[1:int(list_len)])) for x in floats]
-                max_index = normTSS.index(max(normTSS))
-
-                if (((normTSS[max_index]/normTSS[max_index-1]) > 1.5) and
-                    ((normTSS[max_index]/normTSS[max_index+1]) > 1.5)):
-                    tmpTSS = list(normTSS)
-                    del tmpTSS[max_index]
-                    max_index = tmpTSS.index(max(tmpTSS)) + 1
-
-                Tss_score = round(
-                    (sum(normTSS[int(max_index-50):int(max_index+50)])) /
-                    (len(normTSS[int(max_index-50):int(max_index+50)])), 1)
-
-                pm.report_result("TSS_non-coding_score", round(Tss_score, 1))
-            except ZeroDivisionError:
-                pm.report_result("TSS_non-coding_score", 0)
-                pass
+            if tss_failed:
+                pm.warning("Unable to calculate the TSS enrichment profiles")
+            else:
+                pm.report_result("TSS_coding_score", _tss_score(Tss_plus))
+                pm.report_result("TSS_non-coding_score",
+                                 _tss_score(Tss_minus))
 
         # Call Rscript to plot TSS Enrichment
         TSS_pdf = os.path.join(QC_folder,  args.sample_name +
@@ -3156,26 +3495,10 @@ def main():
     chr_order = os.path.join(QC_folder, "chr_order.txt")
     chr_keep = os.path.join(QC_folder, "chr_keep.txt")
 
-    if not os.path.exists(chr_order):
-        cmd = (tools.samtools + " view -H " + mapping_genome_bam +
-               " | grep 'SN:' | awk -F':' '{print $2,$3}' | " +
-               "awk -F' ' -v OFS='\t' '{print $1,$3}' > " + chr_order)
-        pm.run(cmd, chr_order)
-        pm.clean_add(chr_order)
-
-    if not os.path.exists(chr_keep):
-        if os.path.exists(chr_order):
-            cmd = ("cut -f 1 " + chr_order + " > " + chr_keep)
-            pm.run(cmd, chr_keep)
-            pm.clean_add(chr_keep)
-        else:
-            cmd1 = (tools.samtools + " view -H " + mapping_genome_bam +
-                    " | grep 'SN:' | awk -F':' '{print $2,$3}' | " +
-                    "awk -F' ' -v OFS='\t' '{print $1,$3}' > " + chr_order)
-            cmd2 = ("cut -f 1 " + chr_order + " > " + chr_keep)
-            pm.run([cmd1, cmd2], [chr_order, chr_keep])
-            pm.clean_add(chr_order)
-            pm.clean_add(chr_keep)
+    if not os.path.exists(chr_order) or not os.path.exists(chr_keep):
+        _write_chrom_files(tools, mapping_genome_bam, chr_order, chr_keep)
+    pm.clean_add(chr_order)
+    pm.clean_add(chr_keep)
 
     if not os.path.exists(res.pi_tss):
         if not os.path.exists(res.pi_body):
@@ -3201,10 +3524,10 @@ def main():
                 args.genome_assembly + "_pi_tss.bed")
             body_local = os.path.join(QC_folder,
                 args.genome_assembly + "_pi_body.bed")
-            cmd1 = ("grep -wf " + chr_keep + " " + res.pi_tss + " | " +
+            cmd1 = (_keep_chroms(chr_keep, res.pi_tss) + " | " +
                     tools.bedtools + " sort -i stdin -faidx " + chr_order + 
                     " > " + tss_local)
-            cmd2 = ("grep -wf " + chr_keep + " " + res.pi_body +
+            cmd2 = (_keep_chroms(chr_keep, res.pi_body) +
                     " | " + tools.bedtools + " sort -i stdin -faidx " +
                     chr_order + " > " + body_local)
             pm.run([cmd1,cmd2], [tss_local, body_local], nofail=True)
@@ -3214,22 +3537,31 @@ def main():
             # Determine coverage of highest scoring TSS
             TSS_density = os.path.join(QC_folder, args.sample_name +
                                        "_TSS_density.bed")
-            cmd = (tools.bedtools + " coverage -sorted -counts -s -a " +
-                   tss_local + " -b " + mapping_genome_bam +
-                   " -g " + chr_order + " | awk '$7>0' | " + 
-                   "sort -k4,4 -k7,7nr | " +
-                   "sort -k4,4 -u > " + TSS_density)
-            pm.run(cmd, TSS_density, nofail=True)
-            pm.clean_add(TSS_density)
+            TSS_cov = os.path.join(QC_folder, args.sample_name +
+                                   "_TSS_coverage.bed")
+            # bedtools coverage is single threaded; run it per chromosome
+            _coverage_by_chrom(tools, tss_local, mapping_genome_bam,
+                               chr_order, TSS_cov, "-counts -s", nofail=True)
+            cmd1 = ("awk '$7>0' " + TSS_cov + " | sort -k4,4 -k7,7nr | " +
+                    "sort -k4,4 -u > " + TSS_density)
 
             # Determine coverage of gene body
             body_density = os.path.join(QC_folder, args.sample_name +
                                         "_gene_body_density.bed")
-            cmd = (tools.bedtools + " coverage -sorted -counts -s -a " +
-                   body_local + " -b " + mapping_genome_bam +
-                   " -g " + chr_order + " | awk '$7>0' | " + 
-                   "sort -k4 > " + body_density)
-            pm.run(cmd, body_density, nofail=True)
+            body_cov = os.path.join(QC_folder, args.sample_name +
+                                    "_gene_body_coverage.bed")
+            _coverage_by_chrom(tools, body_local, mapping_genome_bam,
+                               chr_order, body_cov, "-counts -s", nofail=True)
+            cmd2 = ("awk '$7>0' " + body_cov + " | sort -k4 > " +
+                    body_density)
+
+            # Wait on both jobs, so neither is left running on a failure
+            pm.run(cmd1 + " & p=$!; " + cmd2 + "; r=$?; wait $p && " +
+                   "[ $r -eq 0 ]", [TSS_density, body_density], shell=True,
+                   nofail=True)
+            pm.clean_add(TSS_cov)
+            pm.clean_add(body_cov)
+            pm.clean_add(TSS_density)
             pm.clean_add(body_density)
 
             # Calculate expression and pause indicies
@@ -3385,7 +3717,7 @@ def main():
                                 args.sample_name + "_gene_coverage.bed")
         gene_sort = os.path.join(QC_folder, args.genome_assembly +
                                  "_gene_sort.bed")
-        cmd1 = ("grep -wf " + chr_keep + " " + res.pre_name +
+        cmd1 = (_keep_chroms(chr_keep, res.pre_name) +
                 " | " + tools.bedtools + " sort -i stdin -faidx " +
                 chr_order + " > " + gene_sort)
         cmd2 = (tools.bedtools + " coverage -sorted -counts -s -a " +
@@ -3450,12 +3782,14 @@ def main():
 
         if os.path.isfile(anno_local):
             # Get list of features
+            with open(anno_local, 'r') as f:
+                features = [line.rstrip("\n").split("\t")[3] for line in f
+                            if line.count("\t") >= 3]
             if args.prioritize:
-                cmd1 = ("cut -f 4 " + anno_local + " | uniq")
+                # keep the order of appearance
+                ft_list = [ft for ft, _ in itertools.groupby(features)]
             else:
-                cmd1 = ("cut -f 4 " + anno_local + " | sort -u")
-            ft_list = pm.checkprint(cmd1, shell=True)
-            ft_list = ft_list.splitlines()
+                ft_list = sorted(set(features))
             if param.precedence.params:
                 p_list = param.precedence.params.split(",")
                 p_list = [feature.strip() for feature in p_list]
@@ -3468,9 +3802,25 @@ def main():
                     pm.warning("Defaulting to the order of features in "
                                "{}".format(anno_local))
 
-            # Split annotation file on features
-            cmd2 = ("awk -F'\t' '{print>\"" + QC_folder + "/\"$4}' " +
-                    anno_local)
+            # Split annotation file on features, once for all features
+            _split_features(anno_local, QC_folder)
+
+            # Every feature is counted against both strands; convert each
+            # strand BAM to BED once rather than decoding the BAM per feature.
+            # The BAMs are coordinate sorted, so the BED files are already in
+            # chr_order
+            plus_bed = os.path.join(QC_folder, args.sample_name + "_plus.bed")
+            minus_bed = os.path.join(QC_folder,
+                                     args.sample_name + "_minus.bed")
+            if ft_list:
+                cmd1 = (tools.bedtools + " bamtobed -i " + plus_bam + " > " +
+                        plus_bed)
+                cmd2 = (tools.bedtools + " bamtobed -i " + minus_bam + " > " +
+                        minus_bed)
+                pm.run(cmd1 + " & p=$!; " + cmd2 + "; r=$?; wait $p && " +
+                       "[ $r -eq 0 ]", [plus_bed, minus_bed], shell=True)
+                pm.clean_add(plus_bed)
+                pm.clean_add(minus_bed)
 
             if args.prioritize:
                 if len(ft_list) >= 1:
@@ -3490,22 +3840,17 @@ def main():
                                                       valid_name +
                                                       "_minus_coverage.bed")
 
-                        # Extract feature files
-                        pm.run(cmd2, anno_file)
-
                         # Rename files to valid file_names
                         # Avoid 'mv' "are the same file" error
                         if not os.path.exists(file_name):
-                            cmd = 'mv "{old}" "{new}"'.format(old=anno_file,
-                                                              new=file_name)
-                            pm.run(cmd, file_name)
+                            os.rename(anno_file, file_name)
 
                         # Sort files (ensure only aligned chromosomes are kept)
                         # Need to cut -f 1-6 if you want strand information
                         # Not all features are stranded
                         # TODO: check for strandedness (*only works on some features)
-                        cmd3 = ("cut -f 1 " + chr_order + " | grep -wf - " +
-                                file_name + " | cut -f 1-3 | " +
+                        cmd3 = (_keep_chroms(chr_keep, file_name) +
+                                " | cut -f 1-3 | " +
                                 "bedtools sort -i stdin -faidx " +
                                 chr_order + " | bedtools merge -i stdin > " +                           
                                 anno_sort)
@@ -3548,26 +3893,29 @@ def main():
 
                     anno_list_plus.reverse()
                     anno_list_minus.reverse()
-                    if len(anno_files) >= 1:
-                        for idx, annotation in enumerate(anno_files):
-                            # Identifies unstranded coverage
-                            # Would need to use '-s' flag to be stranded
-                            if _itsa_file(annotation):
-                                cmd4 = (tools.bedtools +
-                                        " coverage -sorted -a " +
-                                        annotation + " -b " + plus_bam +
-                                        " -g " + chr_order + " > " +
-                                        anno_list_plus[idx])
-                                pm.run(cmd4, cFRiF_PDF)
-                            if _itsa_file(annotation):
-                                cmd5 = (tools.bedtools +
-                                        " coverage -sorted -a " +
-                                        annotation + " -b " + minus_bam +
-                                        " -g " + chr_order + " > " +
-                                        anno_list_minus[idx])
-                                pm.run(cmd5, cFRiF_PDF)
+                    coverage_jobs = []
+                    for idx, annotation in enumerate(anno_files):
+                        # Identifies unstranded coverage
+                        # Would need to use '-s' flag to be stranded
+                        if _itsa_file(annotation):
+                            cmd4 = (tools.bedtools +
+                                    " coverage -sorted -a " +
+                                    annotation + " -b " + plus_bed +
+                                    " -g " + chr_order + " > " +
+                                    anno_list_plus[idx])
+                            cmd5 = (tools.bedtools +
+                                    " coverage -sorted -a " +
+                                    annotation + " -b " + minus_bed +
+                                    " -g " + chr_order + " > " +
+                                    anno_list_minus[idx])
+                            coverage_jobs.extend([cmd4, cmd5])
+                    # bedtools coverage is single threaded; run the features
+                    # and strands at once
+                    _run_concurrently(coverage_jobs, cFRiF_PDF, pm.cores)
             else:
                 if len(ft_list) >= 1:
+                    coverage_jobs = []
+                    coverage_files = []
                     for pos, anno in enumerate(ft_list):
                         # working files
                         anno_file = os.path.join(QC_folder, str(anno))
@@ -3584,22 +3932,17 @@ def main():
                                                       valid_name +
                                                       "_minus_coverage.bed")
 
-                        # Extract feature files
-                        pm.run(cmd2, anno_file)
-
                         # Rename files to valid file_names
                         # Avoid 'mv' "are the same file" error
                         if not os.path.exists(file_name):
-                            cmd = 'mv "{old}" "{new}"'.format(old=anno_file,
-                                                              new=file_name)
-                            pm.run(cmd, file_name)
+                            os.rename(anno_file, file_name)
 
                         # Sort files (ensure only aligned chromosomes are kept)
                         # Need to cut -f 1-6 if you want strand information
                         # Not all features are stranded
                         # TODO: check for strandedness
-                        cmd3 = ("cut -f 1 " + chr_order + " | grep -wf - " +
-                                file_name + " | cut -f 1-3 | " +
+                        cmd3 = (_keep_chroms(chr_keep, file_name) +
+                                " | cut -f 1-3 | " +
                                 "bedtools sort -i stdin -faidx " +
                                 chr_order + " > " + anno_sort)
                         pm.run(cmd3, anno_sort)
@@ -3609,21 +3952,26 @@ def main():
                         # Identifies unstranded coverage
                         # Would need to use '-s' flag to be stranded
                         cmd4 = (tools.bedtools + " coverage -sorted " +
-                                " -a " + anno_sort + " -b " + plus_bam +
+                                " -a " + anno_sort + " -b " + plus_bed +
                                 " -g " + chr_order + " > " +
                                 anno_cov_plus)
                         cmd5 = (tools.bedtools + " coverage -sorted " +
-                                " -a " + anno_sort + " -b " + minus_bam +
+                                " -a " + anno_sort + " -b " + minus_bed +
                                 " -g " + chr_order + " > " +
                                 anno_cov_minus)
-                        pm.run(cmd4, anno_cov_plus)
-                        pm.run(cmd5, anno_cov_minus)
+                        coverage_jobs.extend([cmd4, cmd5])
+                        coverage_files.extend([anno_cov_plus, anno_cov_minus])
 
                         pm.clean_add(file_name)
                         pm.clean_add(anno_sort)
                         pm.clean_add(anno_cov_plus)
                         pm.clean_add(anno_cov_minus)
 
+                    # bedtools coverage is single threaded; run the features
+                    # and strands at once
+                    _run_concurrently(coverage_jobs, coverage_files,
+                                      pm.cores)
+
     ############################################################################
     #                            Plot cFRiF/FRiF                               #
     ############################################################################
@@ -3643,8 +3991,15 @@ def main():
             count_cmd = (tools.samtools + " view -@ " + str(pm.cores) + " " +
                          param.samtools.params + " -c -F4 " + plus_bam)
 
-        plus_read_count = pm.checkprint(count_cmd)
-        plus_read_count = str(plus_read_count).rstrip()
+        # The strand BAMs are already filtered to MAPQ >= 10, so with the
+        # default samtools parameters the index holds the read count
+        if (not args.prioritize and os.path.exists(plus_bam + ".bai") and
+                param.samtools.params.split() in ([], ["-q", "10"])):
+            plus_read_count = str(sum(
+                mapped for mapped, _ in _idxstats(tools, plus_bam).values()))
+        else:
+            plus_read_count = pm.checkprint(count_cmd)
+            plus_read_count = str(plus_read_count).rstrip()
 
         cFRiF_cmd = [tools.Rscript, tool_path("PEPPRO.R"), "frif",
                      "-s", args.sample_name, "-z", str(genome_size).rstrip(),
@@ -3672,12 +4027,13 @@ def main():
                 if _itsa_file(cov):
                     cFRiF_cmd.append(cov)
                     FRiF_cmd.append(cov)
-            cmd = build_command(cFRiF_cmd)
-            pm.run(cmd, cFRiF_PDF, nofail=False)
+            # The plots only read the coverage files; draw them at once and
+            # wait on both
+            cmd = (build_command(cFRiF_cmd) + " & p=$!; " +
+                   build_command(FRiF_cmd) + "; r=$?; wait $p && " +
+                   "[ $r -eq 0 ]")
+            pm.run(cmd, [cFRiF_PDF, FRiF_PDF], shell=True, nofail=False)
             pm.report_object("cFRiF", cFRiF_PDF, anchor_image=cFRiF_PNG)
-
-            cmd = build_command(FRiF_cmd)
-            pm.run(cmd, FRiF_PDF, nofail=False)
             pm.report_object("FRiF", FRiF_PDF, anchor_image=FRiF_PNG)
 
     ############################################################################
@@ -3698,14 +4054,18 @@ def main():
                                       "_exons_sort.bed")
             introns_sort = os.path.join(QC_folder, args.genome_assembly +
                                         "_introns_sort.bed")
-            cmd1 = ("grep -wf " + chr_keep + " " + res.exon_name +
+            cmd1 = (_keep_chroms(chr_keep, res.exon_name) +
                     " | " + tools.bedtools + " sort -i stdin -faidx " +
                     chr_order + " > " + exons_sort)
-            # a single sort fails to sort a 1 bp different start position intron
-            cmd2 = ("grep -wf " + chr_keep + " " + res.intron_name +
-                    " | " + tools.bedtools + " sort -i stdin -faidx " +
-                    chr_order + " | " + tools.bedtools +
-                    " sort -i stdin -faidx " + chr_order + " > " + introns_sort)
+            # a single bedtools sort fails to sort a 1 bp different start
+            # position intron; instead key each line on its chromosome's
+            # position in chr_order (dropping missing chromosomes), start and
+            # end, and sort once on those keys
+            cmd2 = ("awk -v OFS='\t' 'NR==FNR {idx[$1]=NR; next} " +
+                    "($1 in idx) {print idx[$1], $2, $3, $0}' " + chr_order +
+                    " " + res.intron_name + " | sort --parallel=" +
+                    str(pm.cores) + " -k1,1n -k2,2n -k3,3n | cut -f 4- > " +
+                    introns_sort)
             pm.run([cmd1, cmd2], [exons_sort, introns_sort], nofail=True)
             pm.clean_add(exons_sort)
             pm.clean_add(introns_sort)
@@ -3715,13 +4075,13 @@ def main():
                                      "_exons_coverage.bed")
             introns_cov = os.path.join(QC_folder, args.sample_name +
                                        "_introns_coverage.bed")
-            cmd1 = (tools.bedtools + " coverage -sorted -counts -s -a " +
-                    exons_sort + " -b " + mapping_genome_bam +
-                    " -g " + chr_order + " > " + exons_cov)
-            cmd2 = (tools.bedtools + " coverage -sorted -counts -s -a " +
-                    introns_sort + " -b " + mapping_genome_bam +
-                    " -g " + chr_order + " > " + introns_cov)
-            pm.run([cmd1, cmd2], [exons_cov, introns_cov], nofail=True)
+            # bedtools coverage is single threaded; run it per chromosome
+            _coverage_by_chrom(tools, exons_sort, mapping_genome_bam,
+                               chr_order, exons_cov, "-counts -s",
+                               nofail=True)
+            _coverage_by_chrom(tools, introns_sort, mapping_genome_bam,
+                               chr_order, introns_cov, "-counts -s",
+                               nofail=True)
             pm.clean_add(exons_cov)
             pm.clean_add(introns_cov)
 
@@ -3733,101 +4093,38 @@ def main():
                                       "_exons_rpkm.bed")
             introns_rpkm = os.path.join(QC_folder, args.sample_name +
                                         "_introns_rpkm.bed")
-            all_genes = os.path.join(QC_folder, args.sample_name +
-                                     "_all_genes.txt")
-            shared_genes = os.path.join(QC_folder, args.sample_name +
-                                        "_shared_genes.txt")
-            shared_exons = os.path.join(QC_folder, args.sample_name +
-                                        "_shared_exons.bed")
-            shared_introns = os.path.join(QC_folder, args.sample_name +
-                                          "_shared_introns.bed")
-            # determine exonic RPKM for individual genes
-            if os.path.exists(exons_cov):
-                cmd = ("awk -v OFS='\t' '{chrom[$4] = $1; " +
-                       "if($4!=prev4) {chromStart[$4] = $2} " +
-                       "strand[$4] = $6; " +
-                       "readCount[$4] += $7; " + 
-                       "exonCount[$4] += 1; " +
-                       "geneSizeKB[$4] += " +
-                       "(sqrt(($3-$2+0.00000001)^2)/1000); " +
-                       "gene[$4] = $4; " +
-                       "chromEnd[$4]=$3; " +
-                       "prev4=$4} END " +
-                       "{ for (a in readCount) " +
-                       "{ print chrom[a], chromStart[a], " +
-                       "chromEnd[a], gene[a], " +
-                       "(readCount[a]/" + str(scaling_factor) +
-                       ")/geneSizeKB[a], strand[a]}}' " +
-                        exons_cov + " | awk '$5>0' | sort -k4 > " +
-                        exons_rpkm)
-                pm.run(cmd, exons_rpkm, nofail=True)
-                pm.clean_add(exons_rpkm)
-
-            # determine intronic RPKM for individual genes
-            if os.path.exists(introns_cov):
-                cmd = ("awk -v OFS='\t' '{chrom[$4] = $1; " +
-                       "if($4!=prev4) {chromStart[$4] = $2} " +
-                       "strand[$4] = $6; " +
-                       "readCount[$4] += $7; " + 
-                       "exonCount[$4] += 1; " +
-                       "geneSizeKB[$4] += " +
-                       "(sqrt(($3-$2+0.00000001)^2)/1000); " +
-                       "gene[$4] = $4; " +
-                       "chromEnd[$4]=$3; " +
-                       "prev4=$4} END " +
-                       "{ for (a in readCount) " +
-                       "{ print chrom[a], chromStart[a], " +
-                       "chromEnd[a], gene[a], " +
-                       "(readCount[a]/" + str(scaling_factor) +
-                       ")/geneSizeKB[a], strand[a]}}' " +
-                        introns_cov + " | awk '$5>0' | sort -k4 > " +
-                        introns_rpkm)
-                pm.run(cmd, introns_rpkm, nofail=True)
-                pm.clean_add(introns_rpkm)
+            # determine exonic and intronic RPKM for individual genes
+            for coverage, rpkm in [(exons_cov, exons_rpkm),
+                                   (introns_cov, introns_rpkm)]:
+                if (_itsa_file(coverage) and
+                        (not os.path.exists(rpkm) or args.new_start)):
+                    # Continue past a failure, as the awk version did
+                    try:
+                        _gene_rpkm(coverage, rpkm, scaling_factor)
+                    except Exception as e:
+                        pm.warning("Unable to calculate RPKM from {}: {}"
+                                   .format(coverage, e))
+                pm.clean_add(rpkm)
 
             # join intron, exon RPKM on gene name and calculate ratio
-            # MacOS `join` is not equivalent to linux `join`
-            # recreate using `awk`
-            if os.path.exists(exons_rpkm) and os.path.exists(introns_rpkm):
-                # cmd = ("join --nocheck-order -a1 -a2 -j4 " +
-                       # introns_rpkm + " " + exons_rpkm + " | " +
-                       # "awk -v OFS='\t' " +
-                       # "'NF==11 {print $7, $8, $9, $1, ($10/$5), $11}'" +
-                       # " | sort -k1,1 -k2,2n > " + intron_exon)
-                # get all gene names
-                cmd1 = ("cat " + exons_rpkm + " " + introns_rpkm +
-                        " | awk '{print $4}' > " + all_genes)
-                cmd2 = ("awk -F';' '$1 in first{print first[$1] $0; " + 
-                        "first[$1]=\"\"; next} {first[$1]=$0 ORS}' " + 
-                        all_genes + " | awk '!NF {print;next}; !($0 in a) " + 
-                        "{a[$0];print}' > " + shared_genes)
-                cmd3 = ("awk -F '\t' 'NR==FNR {id[$1]; next} $4 in id' " +
-                        shared_genes + " " + exons_rpkm + " > " + shared_exons)
-                cmd4 = ("awk -F '\t' 'NR==FNR {id[$1]; next} $4 in id' " +
-                        shared_genes + " " + introns_rpkm + " > " +
-                        shared_introns)
-                cmd5 = ("awk 'BEGIN{FS=OFS=\"\t\"} FNR>0 && " + 
-                        "FNR==NR{a[$4]=$4 OFS $0; next} " + 
-                        "FNR>0{print $0,a[$4]?a[$4]:\"\t\"}' " +
-                        shared_exons + " " + shared_introns + 
-                        " | awk 'BEGIN { OFS=\"\t\" } " + 
-                        "{print $8, $9, $10, $11, ($12/$5), $13}' " + 
-                        "| sort -k1,1 -k2,2n > " + intron_exon)
-                pm.run([cmd1, cmd2, cmd3, cmd4, cmd5], intron_exon, nofail=True)
-                pm.clean_add(all_genes)
-                pm.clean_add(shared_genes)
-                pm.clean_add(shared_exons)
-                pm.clean_add(shared_introns)
+            if (os.path.exists(exons_rpkm) and os.path.exists(introns_rpkm)
+                    and (not os.path.exists(intron_exon) or args.new_start)):
+                # Continue past a failure, as the awk version did
+                try:
+                    _exon_intron_ratios(exons_rpkm, introns_rpkm,
+                                        intron_exon)
+                except Exception as e:
+                    pm.warning("Unable to calculate exon/intron ratios: {}"
+                               .format(e))
 
             # report median ratio
             if os.path.exists(intron_exon):
-                cmd = ("awk '{print $5}' " + intron_exon +
-                       " | sort -n | awk ' { a[i++]=$1; }" +
-                       " END { x=int((i+1)/2);" +
-                       " if (x < (i+1)/2) print (a[x-1]+a[x])/2;" +
-                       " else print a[x-1]; }'")
-                mrna_con = float(pm.checkprint(cmd))
-                pm.report_result("mRNA_contamination", round(mrna_con, 2))
+                with open(intron_exon, 'r') as f:
+                    ratios = [float(line.split()[4]) for line in f
+                              if line.strip()]
+                if ratios:
+                    mrna_con = float(np.median(ratios))
+                    pm.report_result("mRNA_contamination", round(mrna_con, 2))
 
         # plot mRNA contamination distribution
         mRNApdf = os.path.join(QC_folder,
@@ -3875,33 +4172,36 @@ def main():
         wig_cmd_callable = ngstk.check_command("wigToBigWig")
 
         if wig_cmd_callable:
-            cmd1 = tools.samtools + " index " + plus_bam
+            # The strands share no data; run them at once, splitting the
+            # cores between them
+            wig_threads = max(1, int(pm.cores) // 2)
+            cmd1 = tool_path("bamSitesToWig.py")
+            cmd1 += " -i " + plus_bam
+            cmd1 += " -c " + res.chrom_sizes
+            cmd1 += " -o " + plus_exact_bw  # DEBUG formerly smoothed " -w " + plus_bw
+            cmd1 += " -w " + plus_smooth_bw  
+            cmd1 += " -p " + str(wig_threads)
+            cmd1 += " --variable-step"
+            if args.protocol.lower() in RUNON_SOURCE_PRO:
+                cmd1 += " --tail-edge"
+            if args.scale:
+                cmd1 += " --scale " + str(ar)
+
             cmd2 = tool_path("bamSitesToWig.py")
-            cmd2 += " -i " + plus_bam
+            cmd2 += " -i " + minus_bam
             cmd2 += " -c " + res.chrom_sizes
-            cmd2 += " -o " + plus_exact_bw  # DEBUG formerly smoothed " -w " + plus_bw
-            cmd2 += " -w " + plus_smooth_bw  
-            cmd2 += " -p " + str(int(max(1, int(pm.cores) * 2/3)))
+            cmd2 += " -o " + minus_exact_bw # DEBUG formerly smoothed " -w " + minus_bw
+            cmd2 += " -w " + minus_smooth_bw  
+            cmd2 += " -p " + str(wig_threads)
             cmd2 += " --variable-step"
             if args.protocol.lower() in RUNON_SOURCE_PRO:
                 cmd2 += " --tail-edge"
             if args.scale:
                 cmd2 += " --scale " + str(ar)
-            pm.run([cmd1, cmd2], [plus_exact_bw, plus_smooth_bw])
-
-            cmd3 = tools.samtools + " index " + minus_bam
-            cmd4 = tool_path("bamSitesToWig.py")
-            cmd4 += " -i " + minus_bam
-            cmd4 += " -c " + res.chrom_sizes
-            cmd4 += " -o " + minus_exact_bw # DEBUG formerly smoothed " -w " + minus_bw
-            cmd4 += " -w " + minus_smooth_bw  
-            cmd4 += " -p " + str(int(max(1, int(pm.cores) * 2/3)))
-            cmd4 += " --variable-step"
-            if args.protocol.lower() in RUNON_SOURCE_PRO:
-                cmd4 += " --tail-edge"
-            if args.scale:
-                cmd4 += " --scale " + str(ar)
-            pm.run([cmd3, cmd4], [minus_exact_bw, minus_smooth_bw])
+            pm.run(cmd1 + " & p=$!; " + cmd2 + "; r=$?; wait $p && " +
+                   "[ $r -eq 0 ]",
+                   [plus_exact_bw, plus_smooth_bw,
+                    minus_exact_bw, minus_smooth_bw], shell=True)
         else:
             print("Skipping signal track production -- Could not call \'wigToBigWig\'.")
             print("Check that you have the required UCSC tools in your PATH.")
@@ -3982,7 +4282,10 @@ def main():
                 scale_minus_chunks.extend([("--tail-edge")])
             scale_minus_cmd = build_command(scale_minus_chunks)
 
-        pm.run([scale_plus_cmd, scale_minus_cmd], minus_exact_bw)
+        # The strands only share the read-only seqtable; scale them at once
+        pm.run(scale_plus_cmd + " & p=$!; " + scale_minus_cmd +
+               "; r=$?; wait $p && [ $r -eq 0 ]",
+               [plus_exact_bw, minus_exact_bw], shell=True)
 
     # Remove potentially empty folders
     if os.path.exists(raw_folder) and os.path.isdir(raw_folder):
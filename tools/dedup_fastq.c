@@ -0,0 +1,272 @@
+/*
+ * dedup_fastq: remove reads with duplicate sequences from a fastq file.
+ *
+ * Equivalent to `seqkit rmdup --by-seq --ignore-case`: the first read with a
+ * given sequence is kept and later copies are dropped. Sequences are
+ * compared by a 64-bit hash, as seqkit does, held in an open-addressing
+ * (Robin Hood) table so memory use is 8 bytes per unique sequence. Reads are
+ * hashed in small batches and their table slots prefetched, since the random
+ * table lookups rather than hashing dominate the run time.
+ *
+ *   dedup_fastq [-n expected_reads] <in.fq> <out.fq>
+ *
+ * The input may be plain or gzipped, and an input of "-" reads stdin; an
+ * output ending in .gz is gzipped and an output of "-" writes plain fastq to
+ * stdout. Given the expected number of reads, the table is sized up front
+ * instead of being rehashed as it grows.
+ *
+ * Build: cc -O2 -o dedup_fastq dedup_fastq.c -lz
+ */
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+#include <unistd.h>
+#include <zlib.h>
+
+#define IO_BUFFER (1 << 20)
+#define MIN_SLOTS (1 << 20)
+#define BATCH 16
+
+typedef struct {
+    char *s;
+    size_t len;
+    size_t cap;
+} line_t;
+
+/* Set of 64-bit sequence hashes; 0 marks an empty slot. */
+typedef struct {
+    uint64_t *slots;
+    size_t cap;
+    size_t used;
+} hashset_t;
+
+static void *xcalloc(size_t n, size_t size)
+{
+    void *p = calloc(n, size);
+    if (!p) {
+        fprintf(stderr, "out of memory\n");
+        exit(1);
+    }
+    return p;
+}
+
+/* MurmurHash64A over the upper-cased sequence */
+static uint64_t hash_seq(const char *s, size_t len)
+{
+    const uint64_t m = 0xc6a4a7935bd1e995ULL;
+    const int r = 47;
+    uint64_t h = 0x9747b28cULL ^ (len * m);
+    size_t i = 0;
+
+    for (; i + 8 <= len; i += 8) {
+        uint64_t k;
+        memcpy(&k, s + i, 8);
+        k &= 0xdfdfdfdfdfdfdfdfULL; /* ASCII upper case */
+        k *= m;
+        k ^= k >> r;
+        k *= m;
+        h ^= k;
+        h *= m;
+    }
+    if (i < len) {
+        uint64_t k = 0;
+        memcpy(&k, s + i, len - i);
+        k &= 0xdfdfdfdfdfdfdfdfULL;
+        h ^= k;
+        h *= m;
+    }
+    h ^= h >> r;
+    h *= m;
+    h ^= h >> r;
+    return h ? h : 1;
+}
+
+static int set_insert(hashset_t *set, uint64_t key);
+
+static void set_grow(hashset_t *set)
+{
+    uint64_t *old = set->slots;
+    size_t old_cap = set->cap;
+    size_t i;
+
+    set->cap = old_cap ? old_cap * 2 : MIN_SLOTS;
+    set->slots = xcalloc(set->cap, sizeof(uint64_t));
+    set->used = 0;
+    for (i = 0; i < old_cap; i++) {
+        if (old[i])
+            set_insert(set, old[i]);
+    }
+    free(old);
+}
+
+/* Insert key; return 1 if it was new, 0 if it was already present. */
+static int set_insert(hashset_t *set, uint64_t key)
+{
+    size_t mask, i, dist = 0;
+
+    if ((set->used + 1) * 10 > set->cap * 7)
+        set_grow(set);
+
+    mask = set->cap - 1;
+    i = key & mask;
+    for (;;) {
+        uint64_t cur = set->slots[i];
+        size_t cur_dist;
+
+        if (!cur) {
+            set->slots[i] = key;
+            set->used++;
+            return 1;
+        }
+        if (cur == key)
+            return 0;
+        /* Robin Hood: displace entries closer to their home slot */
+        cur_dist = (i - (cur & mask)) & mask;
+        if (cur_dist < dist) {
+            set->slots[i] = key;
+            key = cur;
+            dist = cur_dist;
+        }
+        i = (i + 1) & mask;
+        dist++;
+    }
+}
+
+/* Read one line, including the newline; return 0 at end of file. */
+static int read_line(gzFile fh, line_t *line)
+{
+    line->len = 0;
+    for (;;) {
+        if (line->cap - line->len < 2) {
+            line->cap = line->cap ? line->cap * 2 : 256;
+            line->s = realloc(line->s, line->cap);
+            if (!line->s) {
+                fprintf(stderr, "out of memory\n");
+                exit(1);
+            }
+        }
+        if (!gzgets(fh, line->s + line->len, (int)(line->cap - line->len)))
+            return line->len > 0;
+        line->len += strlen(line->s + line->len);
+        if (line->len && line->s[line->len - 1] == '\n')
+            return 1;
+    }
+}
+
+/* Allocate enough slots to hold n keys below the maximum load factor. */
+static void set_reserve(hashset_t *set, size_t n)
+{
+    size_t cap = MIN_SLOTS;
+
+    while (cap / 10 * 7 < n)
+        cap *= 2;
+    set->slots = xcalloc(cap, sizeof(uint64_t));
+    set->cap = cap;
+}
+
+int main(int argc, char **argv)
+{
+    gzFile fh_in, fh_out;
+    line_t rec[BATCH][4] = {{{0}}};
+    uint64_t keys[BATCH];
+    hashset_t seen = {0};
+    const char *in_path, *out_path;
+    long reads = 0, dups = 0, expected = 0;
+    size_t n;
+    int i, gz, opt;
+
+    while ((opt = getopt(argc, argv, "n:")) != -1) {
+        if (opt == 'n') {
+            expected = strtol(optarg, NULL, 10);
+        } else {
+            fprintf(stderr, "usage: %s [-n expected_reads] <in.fq> <out.fq>\n",
+                    argv[0]);
+            return 1;
+        }
+    }
+    if (optind != argc - 2) {
+        fprintf(stderr, "usage: %s [-n expected_reads] <in.fq> <out.fq>\n",
+                argv[0]);
+        return 1;
+    }
+    in_path = argv[optind];
+    out_path = argv[optind + 1];
+    if (expected > 0)
+        set_reserve(&seen, (size_t)expected);
+
+    if (strcmp(in_path, "-") == 0)
+        fh_in = gzdopen(STDIN_FILENO, "rb");
+    else
+        fh_in = gzopen(in_path, "rb");
+    if (!fh_in) {
+        fprintf(stderr, "could not open %s\n", in_path);
+        return 1;
+    }
+    gzbuffer(fh_in, IO_BUFFER);
+
+    n = strlen(out_path);
+    gz = n > 3 && strcasecmp(out_path + n - 3, ".gz") == 0;
+    /* "T" writes without compression */
+    if (strcmp(out_path, "-") == 0)
+        fh_out = gzdopen(STDOUT_FILENO, "wT");
+    else
+        fh_out = gzopen(out_path, gz ? "wb6" : "wT");
+    if (!fh_out) {
+        fprintf(stderr, "could not open %s\n", out_path);
+        return 1;
+    }
+    gzbuffer(fh_out, IO_BUFFER);
+
+    for (;;) {
+        int nrec = 0, j;
+
+        /* Hash a batch of reads and prefetch their slots, so the table
+         * lookups wait on memory together rather than one at a time */
+        while (nrec < BATCH && read_line(fh_in, &rec[nrec][0])) {
+            size_t seq_len;
+            line_t *seq = &rec[nrec][1];
+
+            for (i = 1; i < 4; i++) {
+                if (!read_line(fh_in, &rec[nrec][i])) {
+                    fprintf(stderr, "truncated record at read %ld\n",
+                            reads + 1);
+                    return 1;
+                }
+            }
+            reads++;
+
+            seq_len = seq->len;
+            while (seq_len && (seq->s[seq_len - 1] == '\n' ||
+                               seq->s[seq_len - 1] == '\r'))
+                seq_len--;
+            keys[nrec] = hash_seq(seq->s, seq_len);
+            if (seen.cap)
+                __builtin_prefetch(&seen.slots[keys[nrec] & (seen.cap - 1)]);
+            nrec++;
+        }
+        if (!nrec)
+            break;
+
+        for (j = 0; j < nrec; j++) {
+            if (set_insert(&seen, keys[j])) {
+                for (i = 0; i < 4; i++)
+                    gzwrite(fh_out, rec[j][i].s, (unsigned)rec[j][i].len);
+            } else {
+                dups++;
+            }
+        }
+    }
+
+    gzclose(fh_in);
+    if (gzclose(fh_out) != Z_OK) {
+        fprintf(stderr, "error writing %s\n", out_path);
+        return 1;
+    }
+
+    fprintf(stderr, "%ld reads processed\n", reads);
+    fprintf(stderr, "%ld duplicated records removed\n", dups);
+    return 0;
+}
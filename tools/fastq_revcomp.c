@@ -0,0 +1,221 @@
+/*
+ * fastq_revcomp: reverse complement the reads of a fastq file.
+ *
+ * A drop-in replacement for `seqtk seq -r [-L min_len]` on 4-line fastq:
+ * reads shorter than min_len are dropped, sequences are reverse
+ * complemented (IUPAC codes and case are kept, as in seqtk) and qualities
+ * are reversed. Plain fastq is written to stdout.
+ *
+ *   fastq_revcomp [-L min_len] <in.fq>
+ *
+ * The input may be plain or gzipped, or "-" to read from stdin. On CPUs with
+ * AVX2, runs of upper case A/C/G/T/N are complemented 32 bases at a time.
+ *
+ * Build: cc -O2 -o fastq_revcomp fastq_revcomp.c -lz
+ */
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <zlib.h>
+
+#if defined(__x86_64__) && (defined(__GNUC__) || defined(__clang__))
+#include <immintrin.h>
+#define HAVE_AVX2_DISPATCH 1
+#endif
+
+#define IO_BUFFER (1 << 20)
+
+typedef struct {
+    char *s;
+    size_t len;
+    size_t cap;
+} line_t;
+
+static unsigned char comp_table[256];
+
+static void init_comp_table(void)
+{
+    const char *from = "ACGTUMRWSYKVHDBNacgtumrwsykvhdbn";
+    const char *to   = "TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn";
+    int i;
+
+    for (i = 0; i < 256; i++)
+        comp_table[i] = (unsigned char)i;
+    for (i = 0; from[i]; i++)
+        comp_table[(unsigned char)from[i]] = (unsigned char)to[i];
+}
+
+/* Reverse src (complementing it if comp is set) into dst, from offset i. */
+static void revcomp_scalar(const unsigned char *src, unsigned char *dst,
+                           size_t n, size_t i, int comp)
+{
+    for (; i < n; i++)
+        dst[i] = comp ? comp_table[src[n - 1 - i]] : src[n - 1 - i];
+}
+
+#ifdef HAVE_AVX2_DISPATCH
+__attribute__((target("avx2")))
+static void revcomp_avx2(const unsigned char *src, unsigned char *dst,
+                         size_t n, int comp)
+{
+    /* Complement of upper case A/C/G/T/N, indexed by the low nibble */
+    const __m256i lut = _mm256_setr_epi8(
+        0, 'T', 0, 'G', 'A', 0, 0, 'C', 0, 0, 0, 0, 0, 0, 'N', 0,
+        0, 'T', 0, 'G', 'A', 0, 0, 'C', 0, 0, 0, 0, 0, 0, 'N', 0);
+    const __m256i rev = _mm256_setr_epi8(
+        15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0,
+        15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0);
+    const __m256i nibble = _mm256_set1_epi8(0x0f);
+    size_t i = 0;
+
+    for (; i + 32 <= n; i += 32) {
+        __m256i v = _mm256_loadu_si256((const __m256i *)(src + n - 32 - i));
+
+        if (comp) {
+            __m256i c = _mm256_shuffle_epi8(lut, _mm256_and_si256(v, nibble));
+            __m256i back = _mm256_shuffle_epi8(lut,
+                                               _mm256_and_si256(c, nibble));
+
+            /* Anything but A/C/G/T/N doesn't round-trip; leave it to the
+             * table lookup */
+            if (_mm256_movemask_epi8(_mm256_cmpeq_epi8(back, v)) != -1)
+                break;
+            v = c;
+        }
+        /* Reverse the bytes within each lane, then swap the lanes */
+        v = _mm256_shuffle_epi8(v, rev);
+        v = _mm256_permute2x128_si256(v, v, 1);
+        _mm256_storeu_si256((__m256i *)(dst + i), v);
+    }
+    revcomp_scalar(src, dst, n, i, comp);
+}
+#endif
+
+static int use_avx2;
+
+static void revcomp(const unsigned char *src, unsigned char *dst, size_t n,
+                    int comp)
+{
+#ifdef HAVE_AVX2_DISPATCH
+    if (use_avx2) {
+        revcomp_avx2(src, dst, n, comp);
+        return;
+    }
+#endif
+    revcomp_scalar(src, dst, n, 0, comp);
+}
+
+/* Read one line, including the newline; return 0 at end of file. */
+static int read_line(gzFile fh, line_t *line)
+{
+    line->len = 0;
+    for (;;) {
+        if (line->cap - line->len < 2) {
+            line->cap = line->cap ? line->cap * 2 : 256;
+            line->s = realloc(line->s, line->cap);
+            if (!line->s) {
+                fprintf(stderr, "out of memory\n");
+                exit(1);
+            }
+        }
+        if (!gzgets(fh, line->s + line->len, (int)(line->cap - line->len)))
+            return line->len > 0;
+        line->len += strlen(line->s + line->len);
+        if (line->len && line->s[line->len - 1] == '\n')
+            return 1;
+    }
+}
+
+/* Length of a line without its line ending */
+static size_t chomp(const line_t *line)
+{
+    size_t n = line->len;
+
+    while (n && (line->s[n - 1] == '\n' || line->s[n - 1] == '\r'))
+        n--;
+    return n;
+}
+
+int main(int argc, char **argv)
+{
+    gzFile fh_in;
+    line_t rec[4] = {{0}};
+    unsigned char *buf = NULL;
+    size_t buf_cap = 0;
+    long min_len = 0, reads = 0;
+    int i, opt;
+
+    while ((opt = getopt(argc, argv, "L:")) != -1) {
+        if (opt == 'L') {
+            min_len = strtol(optarg, NULL, 10);
+        } else {
+            fprintf(stderr, "usage: %s [-L min_len] <in.fq>\n", argv[0]);
+            return 1;
+        }
+    }
+    if (optind != argc - 1) {
+        fprintf(stderr, "usage: %s [-L min_len] <in.fq>\n", argv[0]);
+        return 1;
+    }
+
+    init_comp_table();
+#ifdef HAVE_AVX2_DISPATCH
+    __builtin_cpu_init();
+    use_avx2 = __builtin_cpu_supports("avx2");
+#endif
+
+    if (strcmp(argv[optind], "-") == 0)
+        fh_in = gzdopen(STDIN_FILENO, "rb");
+    else
+        fh_in = gzopen(argv[optind], "rb");
+    if (!fh_in) {
+        fprintf(stderr, "could not open %s\n", argv[optind]);
+        return 1;
+    }
+    gzbuffer(fh_in, IO_BUFFER);
+    setvbuf(stdout, NULL, _IOFBF, IO_BUFFER);
+
+    while (read_line(fh_in, &rec[0])) {
+        size_t seq_len, qual_len;
+
+        for (i = 1; i < 4; i++) {
+            if (!read_line(fh_in, &rec[i])) {
+                fprintf(stderr, "truncated record at read %ld\n", reads + 1);
+                return 1;
+            }
+        }
+        reads++;
+
+        seq_len = chomp(&rec[1]);
+        if ((long)seq_len < min_len)
+            continue;
+        qual_len = chomp(&rec[3]);
+        if (seq_len > buf_cap || qual_len > buf_cap) {
+            buf_cap = (seq_len > qual_len ? seq_len : qual_len) * 2;
+            buf = realloc(buf, buf_cap);
+            if (!buf) {
+                fprintf(stderr, "out of memory\n");
+                return 1;
+            }
+        }
+
+        fwrite(rec[0].s, 1, chomp(&rec[0]), stdout);
+        revcomp((unsigned char *)rec[1].s, buf, seq_len, 1);
+        fputc('\n', stdout);
+        fwrite(buf, 1, seq_len, stdout);
+        fputs("\n+\n", stdout);
+        revcomp((unsigned char *)rec[3].s, buf, qual_len, 0);
+        fwrite(buf, 1, qual_len, stdout);
+        fputc('\n', stdout);
+    }
+
+    gzclose(fh_in);
+    if (fflush(stdout) != 0) {
+        fprintf(stderr, "error writing output\n");
+        return 1;
+    }
+    return 0;
+}
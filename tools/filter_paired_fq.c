@@ -0,0 +1,269 @@
+/*
+ * filter_paired_fq: re-pair fastq files that have been de-paired by running
+ * a single-end alignment on paired-end data.
+ *
+ * This is a compiled drop-in replacement for filter_paired_fq.pl with the
+ * same arguments and output:
+ *
+ *   filter_paired_fq <filter.fq> <in_R1.fq> <in_R2.fq> <out_R1.fq> <out_R2.fq>
+ *
+ * It assumes the filter file contains a subset of the reads found in the
+ * input files, in the same order. Reads in the inputs that are present in the
+ * filter file are written to the outputs. Inputs may be plain or gzipped;
+ * outputs ending in .gz are gzipped.
+ *
+ * Build: cc -O2 -o filter_paired_fq filter_paired_fq.c -lz
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+#include <zlib.h>
+
+#define BUFFERED_NAMES 1000000
+#define IO_BUFFER (1 << 20)
+
+typedef struct {
+    char *s;
+    size_t len;
+    size_t cap;
+} line_t;
+
+/* Open-addressing set of read names; deleted slots hold a tombstone. */
+static char TOMBSTONE[] = "";
+
+typedef struct {
+    char **slots;
+    size_t cap;
+    size_t used; /* live entries plus tombstones */
+    size_t live;
+} nameset_t;
+
+static void *xmalloc(size_t n)
+{
+    void *p = malloc(n);
+    if (!p) {
+        fprintf(stderr, "out of memory\n");
+        exit(1);
+    }
+    return p;
+}
+
+static size_t hash_name(const char *s)
+{
+    /* FNV-1a */
+    size_t h = 14695981039346656037ULL;
+    while (*s) {
+        h ^= (unsigned char)*s++;
+        h *= 1099511628211ULL;
+    }
+    return h;
+}
+
+static void set_init(nameset_t *set, size_t cap)
+{
+    set->cap = cap;
+    set->used = 0;
+    set->live = 0;
+    set->slots = xmalloc(cap * sizeof(char *));
+    memset(set->slots, 0, cap * sizeof(char *));
+}
+
+static void set_add(nameset_t *set, char *name);
+
+static void set_rehash(nameset_t *set, size_t cap)
+{
+    char **old = set->slots;
+    size_t old_cap = set->cap;
+    size_t i;
+
+    set_init(set, cap);
+    for (i = 0; i < old_cap; i++) {
+        if (old[i] && old[i] != TOMBSTONE)
+            set_add(set, old[i]);
+    }
+    free(old);
+}
+
+static void set_add(nameset_t *set, char *name)
+{
+    size_t i;
+
+    if ((set->used + 1) * 2 > set->cap)
+        set_rehash(set, set->live * 4 > set->cap ? set->cap * 2 : set->cap);
+
+    i = hash_name(name) & (set->cap - 1);
+    while (set->slots[i] && set->slots[i] != TOMBSTONE) {
+        if (strcmp(set->slots[i], name) == 0) {
+            free(name);
+            return;
+        }
+        i = (i + 1) & (set->cap - 1);
+    }
+    if (!set->slots[i])
+        set->used++;
+    set->slots[i] = name;
+    set->live++;
+}
+
+/* Remove name from the set; return 1 if it was present. */
+static int set_remove(nameset_t *set, const char *name)
+{
+    size_t i = hash_name(name) & (set->cap - 1);
+
+    while (set->slots[i]) {
+        if (set->slots[i] != TOMBSTONE && strcmp(set->slots[i], name) == 0) {
+            free(set->slots[i]);
+            set->slots[i] = TOMBSTONE;
+            set->live--;
+            return 1;
+        }
+        i = (i + 1) & (set->cap - 1);
+    }
+    return 0;
+}
+
+/* Read one line, including the newline; return 0 at end of file. */
+static int read_line(gzFile fh, line_t *line)
+{
+    line->len = 0;
+    for (;;) {
+        if (line->cap - line->len < 2) {
+            line->cap = line->cap ? line->cap * 2 : 256;
+            line->s = realloc(line->s, line->cap);
+            if (!line->s) {
+                fprintf(stderr, "out of memory\n");
+                exit(1);
+            }
+        }
+        if (!gzgets(fh, line->s + line->len, (int)(line->cap - line->len)))
+            return line->len > 0;
+        line->len += strlen(line->s + line->len);
+        if (line->len && line->s[line->len - 1] == '\n')
+            return 1;
+    }
+}
+
+/* Copy the read name (up to the first whitespace or '/') of a header line. */
+static char *read_name(const line_t *line)
+{
+    size_t n = strcspn(line->s, " \t\r\n/");
+    char *name = xmalloc(n + 1);
+
+    memcpy(name, line->s, n);
+    name[n] = '\0';
+    return name;
+}
+
+static gzFile open_input(const char *path)
+{
+    gzFile fh = gzopen(path, "rb");
+
+    if (!fh) {
+        fprintf(stderr, "could not open %s\n", path);
+        exit(1);
+    }
+    gzbuffer(fh, IO_BUFFER);
+    return fh;
+}
+
+static gzFile open_output(const char *path)
+{
+    size_t n = strlen(path);
+    /* "T" writes without compression */
+    int gz = n > 3 && strcasecmp(path + n - 3, ".gz") == 0;
+    gzFile fh = gzopen(path, gz ? "wb6" : "wT");
+
+    if (!fh) {
+        fprintf(stderr, "could not open %s\n", path);
+        exit(1);
+    }
+    fprintf(stderr, gz ? "gzipping output\n" : "not gzipping output\n");
+    gzbuffer(fh, IO_BUFFER);
+    return fh;
+}
+
+/* Load the next read name from the filter file into the set. */
+static int load_filter_read(gzFile fh, line_t *line, nameset_t *set)
+{
+    int i;
+
+    if (!read_line(fh, line))
+        return 0;
+    set_add(set, read_name(line));
+    for (i = 0; i < 3; i++)
+        read_line(fh, line);
+    return 1;
+}
+
+int main(int argc, char **argv)
+{
+    gzFile fh_filter, fh_fq1, fh_fq2, fh_out1, fh_out2;
+    line_t line1 = {0}, line2 = {0}, linef = {0};
+    nameset_t names;
+    long skipped = 0;
+    size_t i;
+    int r;
+
+    if (argc != 6) {
+        fprintf(stderr, "usage: %s <filter.fq> <in_R1.fq> <in_R2.fq> "
+                "<out_R1.fq> <out_R2.fq>\n", argv[0]);
+        return 1;
+    }
+
+    fh_filter = open_input(argv[1]);
+    fh_fq1 = open_input(argv[2]);
+    fh_fq2 = open_input(argv[3]);
+    fh_out1 = open_output(argv[4]);
+    fh_out2 = open_output(argv[5]);
+
+    /* load some read names into buffer */
+    set_init(&names, 1 << 21);
+    for (r = 1; r < BUFFERED_NAMES; r++) {
+        if (!load_filter_read(fh_filter, &linef, &names))
+            break;
+    }
+
+    while (read_line(fh_fq2, &line2)) {
+        char *name2 = read_name(&line2);
+
+        read_line(fh_fq1, &line1);
+        if (set_remove(&names, name2)) {
+            gzwrite(fh_out2, line2.s, (unsigned)line2.len);
+            gzwrite(fh_out1, line1.s, (unsigned)line1.len);
+            for (i = 0; i < 3; i++) {
+                if (read_line(fh_fq2, &line2))
+                    gzwrite(fh_out2, line2.s, (unsigned)line2.len);
+                if (read_line(fh_fq1, &line1))
+                    gzwrite(fh_out1, line1.s, (unsigned)line1.len);
+            }
+            /* Parse in a new read from the filter */
+            load_filter_read(fh_filter, &linef, &names);
+        } else {
+            /* advance to next r2 read */
+            skipped++;
+            for (i = 0; i < 3; i++) {
+                read_line(fh_fq2, &line2);
+                read_line(fh_fq1, &line1);
+            }
+        }
+        free(name2);
+    }
+
+    gzclose(fh_out1);
+    gzclose(fh_out2);
+    gzclose(fh_filter);
+    gzclose(fh_fq1);
+    gzclose(fh_fq2);
+
+    fprintf(stderr, "%ld reads skipped\n", skipped);
+    fprintf(stderr, "%zu reads lost\n", names.live);
+    if (names.live < 200) {
+        for (i = 0; i < names.cap; i++) {
+            if (names.slots[i] && names.slots[i] != TOMBSTONE)
+                fprintf(stderr, "%s\n", names.slots[i]);
+        }
+    }
+    return 0;
+}